@@ -1,18 +1,30 @@
 import streamlit as st
-import google.generativeai as genai
-import fitz  # PyMuPDF
 from PIL import Image
 import io
+import math
 import json
-import pandas as pd
 import logging
 import sys
 import base64
-from google.ai.generativelanguage_v1beta.types import content
 import traceback
 import time
-import tempfile
 import os
+import threading
+import hashlib
+import sqlite3
+import datetime
+import random
+import queue
+import re
+import pickle
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+# google.generativeai、google.api_core（会加载 grpc）、fitz (PyMuPDF) 和 pandas 导入很慢，
+# 只在用到的函数里导入，
+# 没上传文件时打开页面不需要加载它们
 
 # 配置日志
 logging.basicConfig(
@@ -24,68 +36,147 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# 设置页面配置
-st.set_page_config(page_title="PDF AI阅读助手", layout="wide")
+# 模型名称
+MODEL_NAME = "gemini-2.0-flash"
+
+# 生成配置；结构化输出的 schema 由 generation_config_for 按提示词模板加上
+GENERATION_CONFIG = {
+    "temperature": 1,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 81920,
+    "response_mime_type": "application/json",
+}
+
+
+# 默认并发配置，可在 secrets.toml 中通过 GEMINI_MAX_WORKERS / GEMINI_PER_KEY_CONCURRENCY 覆盖
+DEFAULT_MAX_WORKERS = 8
+DEFAULT_PER_KEY_CONCURRENCY = 2
+
+
+class GeminiKeySlot:
+    """单个API密钥对应的模型、文件客户端和在途请求计数"""
+
+    def __init__(self, index, api_key, generation_config, max_concurrency):
+        import google.ai.generativelanguage as glm
+        import google.generativeai as genai
+        from google.generativeai.client import FileServiceClient
+
+        self.index = index
+        # 密钥指纹，用于区分各密钥名下上传的文件，不保存明文密钥
+        self.key_id = hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+        self.max_concurrency = max_concurrency
+        self.in_flight = 0
+        self.model = genai.GenerativeModel(
+            model_name=MODEL_NAME,
+            generation_config=generation_config
+        )
+        # 每个密钥使用独立的客户端，避免 genai.configure 的全局状态在线程之间互相覆盖
+        self.model._client = glm.GenerativeServiceClient(
+            client_options={"api_key": api_key})
+        self.file_client = FileServiceClient(
+            client_options={"api_key": api_key})
+        self.cache_client = glm.CacheServiceClient(
+            client_options={"api_key": api_key})
+        self.generation_config = generation_config
+
+
+class GeminiKeyPool:
+    """在所有 GOOGLE_API_KEYS 之间轮换分配请求，并限制每个密钥的并发数"""
+
+    def __init__(self, api_keys, generation_config,
+                 per_key_concurrency=DEFAULT_PER_KEY_CONCURRENCY,
+                 max_workers=DEFAULT_MAX_WORKERS, max_in_flight=None):
+        self.slots = [
+            GeminiKeySlot(i, key, generation_config, per_key_concurrency)
+            for i, key in enumerate(api_keys)
+        ]
+        self.max_workers = max_workers
+        self.model_name = MODEL_NAME
+        self.generation_config = generation_config
+        # 所有密钥合计的在途请求上限，None 表示只受每个密钥的并发限制
+        self.max_in_flight = max_in_flight
+        self._available = threading.Condition()
+        self._next_slot = 0
+
+    @property
+    def capacity(self):
+        """所有密钥加起来允许的最大在途请求数"""
+        capacity = sum(slot.max_concurrency for slot in self.slots)
+        if self.max_in_flight is not None:
+            capacity = min(capacity, self.max_in_flight)
+        return capacity
+
+    def _pick_slot(self):
+        if (self.max_in_flight is not None and
+                sum(slot.in_flight for slot in self.slots) >= self.max_in_flight):
+            return None
+        # 从上次的位置开始轮询，选第一个还有空闲并发额度的密钥
+        for offset in range(len(self.slots)):
+            slot = self.slots[(self._next_slot + offset) % len(self.slots)]
+            if slot.in_flight < slot.max_concurrency:
+                self._next_slot = (slot.index + 1) % len(self.slots)
+                return slot
+        return None
+
+    @contextmanager
+    def acquire(self):
+        """占用一个有空闲额度的密钥，直到 with 块结束"""
+        with self._available:
+            slot = self._pick_slot()
+            while slot is None:
+                self._available.wait()
+                slot = self._pick_slot()
+            slot.in_flight += 1
+        try:
+            yield slot
+        finally:
+            with self._available:
+                slot.in_flight -= 1
+                self._available.notify()
+
 
 # 初始化Gemini
 
 
+@st.cache_resource(show_spinner=False)
+def get_key_pool(api_keys, per_key_concurrency, max_workers, config_key):
+    """整个进程只构建一次模型和客户端，所有会话和重新运行共用
+
+    以密钥列表、并发配置和 config_key（生成配置与提示词的摘要）为缓存键，
+    任何一项变化都会重新构建。
+    """
+    import google.generativeai as genai
+
+    logger.info("开始初始化Gemini模型")
+    genai.configure(api_key=api_keys[0])
+    logger.info(f"已配置API密钥，共 {len(api_keys)} 个")
+    pool = GeminiKeyPool(
+        list(api_keys),
+        generation_config_for(prompt),
+        per_key_concurrency=per_key_concurrency,
+        max_workers=max_workers,
+    )
+    logger.info("Gemini模型初始化成功")
+    return pool
+
+
 def initialize_gemini():
     try:
-        logger.info("开始初始化Gemini模型")
         api_keys = st.secrets["GOOGLE_API_KEYS"]
         if not api_keys:
             logger.error("API密钥未设置")
             st.error("请在secrets.toml中设置GOOGLE_API_KEYS")
             return None
 
-        genai.configure(api_key=api_keys[0])
-        logger.info("已配置API密钥")
-
-        # 配置结构化输出
-        generation_config = {
-            "temperature": 1,
-            "top_p": 0.95,
-            "top_k": 40,
-            "max_output_tokens": 81920,
-            # "response_schema": genai.protos.Schema(
-            #     type=genai.protos.Type.OBJECT,
-            #     properties={
-            #         "產品亮點": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "市场价格": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "直播价格": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "产品信息": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "口味": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "赠品": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "产品卖点": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #         "其他优势": genai.protos.Schema(
-            #             type=genai.protos.Type.STRING,
-            #         ),
-            #     },
-            # ),
-            "response_mime_type": "application/json",
-        }
-
-        model = genai.GenerativeModel(
-            model_name="gemini-2.0-flash",
-            generation_config=generation_config
+        config_key = hashlib.sha256(json.dumps(
+            GENERATION_CONFIG, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+        return get_key_pool(
+            tuple(api_keys),
+            int(st.secrets.get("GEMINI_PER_KEY_CONCURRENCY", DEFAULT_PER_KEY_CONCURRENCY)),
+            int(st.secrets.get("GEMINI_MAX_WORKERS", DEFAULT_MAX_WORKERS)),
+            f"{config_key}-{prompt_digest()}",
         )
-        logger.info("Gemini模型初始化成功")
-        return model
     except Exception as e:
         logger.error(f"初始化Gemini时出错: {str(e)}")
         logger.error(traceback.format_exc())
@@ -93,7 +184,205 @@ def initialize_gemini():
         return None
 
 
-def resize_image(image, max_size=1024):
+# 性能统计的阶段：render 渲染、encode 编码、text 提取文字层、store 写入页面存储、
+# upload 发送图片、generate 等待生成、parse 解析和修复响应
+METRIC_STAGES = ("render", "encode", "text", "store", "upload", "generate", "parse")
+
+
+def _percentile(sorted_values, quantile):
+    """最近秩百分位数，values 需已排序"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(quantile * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class RunMetrics:
+    """一次任务的分阶段耗时和token统计，可导出为JSON或Prometheus文本"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.finished = None
+        self.pages = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.spans = []  # (阶段, 页码, 秒)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage, page=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.spans.append((stage, page, elapsed))
+
+    def add_usage(self, usage_metadata):
+        """累加响应 usage_metadata 里的输入和输出token"""
+        if usage_metadata is None:
+            return
+        with self._lock:
+            self.prompt_tokens += getattr(usage_metadata, "prompt_token_count", 0) or 0
+            self.output_tokens += getattr(usage_metadata, "candidates_token_count", 0) or 0
+
+    def page_done(self):
+        with self._lock:
+            self.pages += 1
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+            pages = self.pages
+            prompt_tokens, output_tokens = self.prompt_tokens, self.output_tokens
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        durations = {}
+        for stage, _, seconds in spans:
+            durations.setdefault(stage, []).append(seconds)
+        stages = {}
+        for stage in sorted(durations, key=lambda s: (
+                METRIC_STAGES.index(s) if s in METRIC_STAGES else len(METRIC_STAGES), s)):
+            values = sorted(durations[stage])
+            stages[stage] = {
+                "count": len(values),
+                "total_seconds": sum(values),
+                "p50_ms": _percentile(values, 0.5) * 1000,
+                "p95_ms": _percentile(values, 0.95) * 1000,
+            }
+        return {
+            "pages": pages,
+            "elapsed_seconds": elapsed,
+            "pages_per_second": pages / elapsed if elapsed > 0 else 0.0,
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "tokens_per_page": (prompt_tokens + output_tokens) / pages if pages else 0.0,
+            "stages": stages,
+        }
+
+    def to_json(self, include_spans=True):
+        data = self.summary()
+        if include_spans:
+            with self._lock:
+                data["spans"] = [
+                    {"stage": stage, "page": page, "seconds": seconds}
+                    for stage, page, seconds in self.spans
+                ]
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+    def to_prometheus(self, prefix="pdf_reader"):
+        """Prometheus 文本格式，阶段耗时以 summary 类型导出"""
+        summary = self.summary()
+        lines = [
+            f"# HELP {prefix}_stage_seconds Per-page latency of each processing stage.",
+            f"# TYPE {prefix}_stage_seconds summary",
+        ]
+        for stage, stats in summary["stages"].items():
+            for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms")):
+                lines.append(f'{prefix}_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                             f'{stats[key] / 1000:.6f}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{stage}"}} '
+                         f'{stats["total_seconds"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{stage}"}} {stats["count"]}')
+        lines += [
+            f"# HELP {prefix}_pages_total Pages analyzed in this run.",
+            f"# TYPE {prefix}_pages_total counter",
+            f"{prefix}_pages_total {summary['pages']}",
+            f"# HELP {prefix}_pages_per_second Throughput of this run.",
+            f"# TYPE {prefix}_pages_per_second gauge",
+            f"{prefix}_pages_per_second {summary['pages_per_second']:.6f}",
+            f"# HELP {prefix}_tokens_total Tokens reported by usage_metadata.",
+            f"# TYPE {prefix}_tokens_total counter",
+            f'{prefix}_tokens_total{{kind="prompt"}} {summary["prompt_tokens"]}',
+            f'{prefix}_tokens_total{{kind="output"}} {summary["output_tokens"]}',
+            f"# HELP {prefix}_tokens_per_page Average tokens per analyzed page.",
+            f"# TYPE {prefix}_tokens_per_page gauge",
+            f"{prefix}_tokens_per_page {summary['tokens_per_page']:.3f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+
+def metric_span(metrics, stage, page=None):
+    """metrics 为 None 时不计时"""
+    if metrics is None:
+        return nullcontext()
+    return metrics.span(stage, page)
+
+
+# 页面图片设置：渲染上限150 DPI，长边不超过1024像素
+RENDER_DPI = 150
+MAX_IMAGE_SIZE = 1024
+IMAGE_FORMATS = {
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+    "png": "image/png",
+}
+DEFAULT_IMAGE_FORMAT = "jpeg"
+DEFAULT_IMAGE_QUALITY = 85
+
+
+class PageImage:
+    """已编码的页面图片，只保存压缩后的字节，不保存解码后的像素
+
+    text 是整页渲染时顺带取出的文字层（扫描件为空），用于判断重复页面。
+    """
+
+    # 结果里显示的处理方式
+    route = "图片"
+
+    def __init__(self, data, mime_type, size, text=""):
+        self.data = data
+        self.mime_type = mime_type
+        self.size = size
+        self.text = text
+
+    def to_pil(self):
+        """需要显示或兼容旧代码时再解码"""
+        return Image.open(io.BytesIO(self.data))
+
+
+class PageText:
+    """文字层足够的页面：只发送提取出的文字和裁剪出的插图，不渲染整页"""
+
+    route = "文本"
+
+    def __init__(self, text, figures=()):
+        self.text = text
+        self.figures = list(figures)
+
+    @property
+    def data(self):
+        """用于计算缓存键和统计大小"""
+        return self.text.encode("utf-8") + b"".join(
+            figure.data for figure in self.figures)
+
+    def to_pil(self):
+        """有插图时显示第一张插图"""
+        return self.figures[0].to_pil() if self.figures else None
+
+
+# 页面提取方式：image 总是整页渲染；hybrid 文字层足够时只发送文字和插图
+EXTRACTION_MODES = {
+    "image": "整页图片",
+    "hybrid": "文字优先",
+}
+DEFAULT_EXTRACTION_MODE = "image"
+# 文字少于这个字数的页面视为扫描页或图片页
+TEXT_MIN_CHARS = 200
+# 判断文字层里是否有价格
+PRICE_PATTERN = re.compile(r"[¥￥$]\s*\d|\d+(?:\.\d+)?\s*元|\d+\.\d{1,2}(?!\d)")
+# 插图至少占页面面积的比例，以及每页最多发送几张
+FIGURE_MIN_AREA = 0.05
+FIGURE_MAX_COUNT = 3
+FIGURE_MAX_SIZE = 512
+# 单张图片覆盖页面超过这个比例时，视为扫描页（即使带有OCR文字层）
+SCANNED_PAGE_AREA = 0.8
+
+
+def resize_image(image, max_size=MAX_IMAGE_SIZE):
     """调整图片大小，确保不超过API限制"""
     width, height = image.size
     if width > max_size or height > max_size:
@@ -103,42 +392,423 @@ def resize_image(image, max_size=1024):
     return image
 
 
-def convert_pdf_to_images(pdf_file):
-    try:
-        logger.info("开始转换PDF文件")
-        images = []
-        pdf_data = pdf_file.read()
+def encode_image(image, image_format=DEFAULT_IMAGE_FORMAT,
+                 quality=DEFAULT_IMAGE_QUALITY):
+    """把PIL图片编码为 PageImage，兼容旧的图片列表"""
+    if isinstance(image, (PageImage, PageText)):
+        return image
+    image = resize_image(image)
+    if image_format != "png" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    buffered = io.BytesIO()
+    image.save(buffered, format=image_format.upper(), quality=quality)
+    return PageImage(buffered.getvalue(), IMAGE_FORMATS[image_format], image.size)
+
+
+def render_page(page, image_format=DEFAULT_IMAGE_FORMAT,
+                quality=DEFAULT_IMAGE_QUALITY, max_size=MAX_IMAGE_SIZE, clip=None,
+                metrics=None):
+    """直接按目标尺寸渲染页面（或 clip 指定的区域）并只编码一次"""
+    import fitz  # PyMuPDF
+
+    rect = clip if clip is not None else page.rect
+    # 计算缩放比例，让渲染结果直接落在长边 max_size 以内，省去先渲染再缩放
+    zoom = min(RENDER_DPI / 72, max_size / max(rect.width, rect.height) * 0.999)
+    with metric_span(metrics, "render", page.number + 1):
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip, alpha=False)
+
+    with metric_span(metrics, "encode", page.number + 1):
+        if image_format == "png":
+            data = pix.tobytes("png")
+        elif image_format == "jpeg":
+            data = pix.tobytes("jpeg", jpg_quality=quality)
+        else:
+            # PyMuPDF 不支持直接输出 WebP，借助 Pillow 从原始像素编码
+            img = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+            buffered = io.BytesIO()
+            img.save(buffered, format="WEBP", quality=quality)
+            data = buffered.getvalue()
+    text = page.get_text("text") if clip is None else ""
+    return PageImage(data, IMAGE_FORMATS[image_format], (pix.width, pix.height), text)
+
+
+def extract_page_text(page, image_format=DEFAULT_IMAGE_FORMAT,
+                      quality=DEFAULT_IMAGE_QUALITY, min_chars=TEXT_MIN_CHARS,
+                      metrics=None):
+    """文字层足够（包括价格）时返回 PageText，否则返回 None 表示需要整页图片"""
+    import fitz  # PyMuPDF
+
+    with metric_span(metrics, "text", page.number + 1):
+        text = page.get_text("text", sort=True)
+        lines = (" ".join(line.split()) for line in text.splitlines())
+        text = "\n".join(line for line in lines if line)
+        if len(text) < min_chars or not PRICE_PATTERN.search(text):
+            return None
+
+        page_area = page.rect.get_area()
+        rects = []
+        for info in page.get_image_info():
+            rect = fitz.Rect(info["bbox"]) & page.rect
+            if rect.is_empty:
+                continue
+            if rect.get_area() >= page_area * SCANNED_PAGE_AREA:
+                return None
+            if rect.get_area() >= page_area * FIGURE_MIN_AREA:
+                rects.append(rect)
+
+    # 只裁剪最大的几张插图，按较小的尺寸渲染
+    rects.sort(key=lambda rect: rect.get_area(), reverse=True)
+    figures = [
+        render_page(page, image_format, quality, max_size=FIGURE_MAX_SIZE, clip=rect,
+                    metrics=metrics)
+        for rect in rects[:FIGURE_MAX_COUNT]
+    ]
+    return PageText(text, figures)
+
+
+def count_pdf_pages(pdf_data):
+    """只打开PDF读取页数，不做渲染"""
+    import fitz  # PyMuPDF
+
+    with fitz.open(stream=pdf_data, filetype="pdf") as pdf_document:
+        return pdf_document.page_count
+
+
+def iter_pdf_images(pdf_data, image_format=DEFAULT_IMAGE_FORMAT,
+                    quality=DEFAULT_IMAGE_QUALITY, page_indices=None,
+                    extraction_mode=DEFAULT_EXTRACTION_MODE, metrics=None):
+    """逐页惰性渲染PDF，每次只产出一页图片，内存占用不随页数增长
 
+    page_indices 指定只渲染哪些页（从0开始），用于断点续跑时跳过已完成的页面。
+    extraction_mode 为 hybrid 时，文字层足够的页面产出 PageText，不做整页渲染。
+    传入 metrics 时记录每页各阶段的耗时。
+    """
+    import fitz  # PyMuPDF
+
+    try:
         pdf_document = fitz.open(stream=pdf_data, filetype="pdf")
         logger.info(f"PDF文件共 {pdf_document.page_count} 页")
 
-        for page_num in range(pdf_document.page_count):
-            logger.info(f"正在轉換第 {page_num + 1} 页")
-            page = pdf_document[page_num]
-            # 降低分辨率以减小文件大小
-            pix = page.get_pixmap(matrix=fitz.Matrix(
-                150/72, 150/72))  # 降至150 DPI
-
-            img_data = pix.tobytes("png")
-            img = Image.open(io.BytesIO(img_data))
-            # 调整图片大小
-            img = resize_image(img)
-            images.append(img)
-            logger.info(f"第 {page_num + 1} 页处理完成，图片大小: {img.size}")
-
-        pdf_document.close()
+        try:
+            if page_indices is None:
+                page_indices = range(pdf_document.page_count)
+            for page_num in page_indices:
+                logger.info(f"正在轉換第 {page_num + 1} 页")
+                page = pdf_document[page_num]
+                if extraction_mode == "hybrid":
+                    page_text = extract_page_text(
+                        page, image_format, quality, metrics=metrics)
+                    if page_text is not None:
+                        logger.info(
+                            f"第 {page_num + 1} 页使用文字层，{len(page_text.text)} 字，"
+                            f"{len(page_text.figures)} 张插图")
+                        yield page_text
+                        continue
+                page_image = render_page(page, image_format, quality, metrics=metrics)
+                logger.info(
+                    f"第 {page_num + 1} 页处理完成，图片大小: {page_image.size}，"
+                    f"{len(page_image.data) // 1024} KB")
+                yield page_image
+        finally:
+            pdf_document.close()
         logger.info("PDF转换完成")
-        return images
     except Exception as e:
         logger.error(f"转换PDF时出错: {str(e)}")
         logger.error(traceback.format_exc())
         raise
 
+
+# 页面存储中保留的已解码图片数量，只用于界面显示
+PAGE_STORE_DECODED_CACHE = 8
+
+
+class PageStore:
+    """把已编码的页面图片写到临时目录，内存里只保留少量解码后的图片
+
+    取代在 session_state 里保存每一页的解码图片：页面字节放在磁盘上，
+    需要分析时按需读取，需要显示时解码并放进一个小的 LRU。
+    """
+
+    def __init__(self, decoded_cache_size=PAGE_STORE_DECODED_CACHE):
+        self.directory = tempfile.mkdtemp(prefix="pdf-pages-")
+        self._pages = {}  # page_index -> 文件路径
+        self._decoded = OrderedDict()
+        self._decoded_cache_size = decoded_cache_size
+        self._lock = threading.Lock()
+        # 会话结束对象被回收时自动删除临时目录
+        self._finalizer = weakref.finalize(
+            self, shutil.rmtree, self.directory, ignore_errors=True)
+
+    def __len__(self):
+        return len(self._pages)
+
+    def __contains__(self, page_index):
+        return page_index in self._pages
+
+    def put(self, page_index, page_image):
+        """保存 PageImage 或 PageText，图片部分仍然是压缩字节"""
+        path = os.path.join(self.directory, f"{page_index}")
+        with open(path, "wb") as f:
+            pickle.dump(page_image, f, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._pages[page_index] = path
+            self._decoded.pop(page_index, None)
+
+    def get(self, page_index):
+        """读取已编码的页面（不解码）"""
+        with open(self._pages[page_index], "rb") as f:
+            return pickle.load(f)
+
+    def image(self, page_index):
+        """返回解码后的 PIL 图片，最近用过的几页留在内存里；纯文字页返回 None"""
+        with self._lock:
+            if page_index in self._decoded:
+                self._decoded.move_to_end(page_index)
+                return self._decoded[page_index]
+        img = self.get(page_index).to_pil()
+        if img is None:
+            return None
+        img.load()
+        with self._lock:
+            self._decoded[page_index] = img
+            while len(self._decoded) > self._decoded_cache_size:
+                self._decoded.popitem(last=False)
+        return img
+
+    def iter_pages(self, page_indices=None):
+        """按需从磁盘逐页读取，供 analyze_pages 使用"""
+        if page_indices is None:
+            page_indices = sorted(self._pages)
+        for page_index in page_indices:
+            yield self.get(page_index)
+
+    def spool(self, page_images, page_indices, metrics=None):
+        """边渲染边写入磁盘，同时把页面继续交给下游"""
+        for page_index, page_image in zip(page_indices, page_images):
+            with metric_span(metrics, "store", page_index + 1):
+                self.put(page_index, page_image)
+            yield page_image
+
+    def release(self, page_index):
+        """删除已经不需要的页面"""
+        with self._lock:
+            entry = self._pages.pop(page_index, None)
+            self._decoded.pop(page_index, None)
+        if entry is not None:
+            try:
+                os.unlink(entry)
+            except OSError:
+                pass
+
+    def close(self):
+        with self._lock:
+            self._pages.clear()
+            self._decoded.clear()
+        self._finalizer()
+
+
+def convert_pdf_to_images(pdf_file, image_format=DEFAULT_IMAGE_FORMAT,
+                          quality=DEFAULT_IMAGE_QUALITY, metrics=None):
+    logger.info("开始转换PDF文件")
+    return list(iter_pdf_images(pdf_file.read(), image_format, quality, metrics=metrics))
+
+# 图片发送方式：auto 小图内联、大图走文件上传；inline 全部内联；files 全部走文件上传并复用
+UPLOAD_MODES = {
+    "auto": "自动（小图内联）",
+    "inline": "内联发送",
+    "files": "上传并复用",
+}
+DEFAULT_UPLOAD_MODE = "auto"
+# 内联图片上限，整个请求不能超过 20MB，这里留足余量给提示词
+INLINE_MAX_BYTES = 4 * 1024 * 1024
+DEFAULT_UPLOAD_REGISTRY_PATH = os.path.join(".cache", "uploads.sqlite3")
+# 距离过期不足这个时间的已上传文件不再复用
+UPLOAD_REUSE_MARGIN = 10 * 60
+# Files API 文件保留 48 小时，拿不到过期时间时按这个估算
+UPLOAD_DEFAULT_TTL = 47 * 3600
+
+
+class UploadRegistry:
+    """图片哈希 → 已上传文件URI 的登记表，按密钥区分，过期前可重复使用"""
+
+    def __init__(self, path=DEFAULT_UPLOAD_REGISTRY_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " digest TEXT NOT NULL,"
+            " key_id TEXT NOT NULL,"
+            " name TEXT NOT NULL,"
+            " uri TEXT NOT NULL,"
+            " mime_type TEXT NOT NULL,"
+            " expires REAL NOT NULL,"
+            " PRIMARY KEY (digest, key_id))")
+        self._conn.commit()
+
+    def get(self, digest, key_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT uri, mime_type FROM uploads"
+                " WHERE digest = ? AND key_id = ? AND expires > ?",
+                (digest, key_id, time.time() + UPLOAD_REUSE_MARGIN)).fetchone()
+        return row
+
+    def put(self, digest, key_id, name, uri, mime_type, expires):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?)",
+                (digest, key_id, name, uri, mime_type, expires))
+            self._conn.commit()
+
+    def live_names(self, key_id):
+        """仍可复用的文件名集合"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name FROM uploads WHERE key_id = ? AND expires > ?",
+                (key_id, time.time() + UPLOAD_REUSE_MARGIN)).fetchall()
+        return {row[0] for row in rows}
+
+    def forget(self, key_id, names):
+        with self._lock:
+            self._conn.executemany(
+                "DELETE FROM uploads WHERE key_id = ? AND name = ?",
+                [(key_id, name) for name in names])
+            self._conn.execute(
+                "DELETE FROM uploads WHERE expires <= ?", (time.time(),))
+            self._conn.commit()
+
+
+class ImageUploader:
+    """决定页面图片以内联字节还是已上传文件的形式放进请求"""
+
+    def __init__(self, mode=DEFAULT_UPLOAD_MODE, registry=None,
+                 inline_max_bytes=INLINE_MAX_BYTES):
+        self.mode = mode
+        self.registry = registry
+        self.inline_max_bytes = inline_max_bytes
+
+    def image_part(self, page_image, page_num, file_client=None, key_id=None):
+        if self.mode == "inline" or (
+                self.mode == "auto" and len(page_image.data) <= self.inline_max_bytes):
+            # 图片字节直接随请求发送，省掉一次上传往返
+            logger.info(f"第 {page_num} 页图片内联发送 ({len(page_image.data) // 1024} KB)")
+            return {"mime_type": page_image.mime_type, "data": page_image.data}
+
+        digest = hashlib.sha256(page_image.data).hexdigest()
+        if self.registry is not None:
+            row = self.registry.get(digest, key_id)
+            if row is not None:
+                import google.generativeai as genai
+
+                logger.info(f"第 {page_num} 页复用已上传文件: {row[0]}")
+                return genai.protos.FileData(file_uri=row[0], mime_type=row[1])
+
+        uploaded_file = upload_page_image(page_image, page_num, file_client)
+        if self.registry is not None:
+            expires = time.time() + UPLOAD_DEFAULT_TTL
+            if uploaded_file.expiration_time:
+                expires = uploaded_file.expiration_time.timestamp()
+            self.registry.put(digest, key_id, uploaded_file.name, uploaded_file.uri,
+                              page_image.mime_type, expires)
+        return uploaded_file
+
+
+# 本应用上传的文件都带这个 display_name 前缀，清理时不会误删共用密钥的其他程序上传的文件
+UPLOAD_DISPLAY_NAME_PREFIX = "pdf-ai-reader-"
+
+
+def upload_page_image(page_image, page_num, file_client=None):
+    """把已编码的页面图片从内存上传到 Files API"""
+    logger.info(f"上传图片到Gemini - 第 {page_num} 页")
+    display_name = f"{UPLOAD_DISPLAY_NAME_PREFIX}page-{page_num}"
+    if file_client is not None:
+        uploaded_file = file_client.create_file(
+            io.BytesIO(page_image.data), mime_type=page_image.mime_type,
+            display_name=display_name)
+    else:
+        import google.generativeai as genai
+
+        uploaded_file = genai.upload_file(
+            io.BytesIO(page_image.data), mime_type=page_image.mime_type,
+            display_name=display_name)
+    logger.info(f"图片上传成功: {uploaded_file.uri}")
+    return uploaded_file
+
+
+def cleanup_stale_uploads(pool, registry=None):
+    """批量删除各密钥名下本应用上传、且不再复用的文件，返回删除数量"""
+    deleted = 0
+    for slot in pool.slots:
+        keep = registry.live_names(slot.key_id) if registry is not None else set()
+        # 先列完再删除，避免边翻页边删除导致漏掉文件
+        candidates = [
+            uploaded_file.name
+            for uploaded_file in slot.file_client.list_files({"page_size": 100})
+            if uploaded_file.display_name.startswith(UPLOAD_DISPLAY_NAME_PREFIX) and
+            uploaded_file.name not in keep
+        ]
+        stale = []
+        for name in candidates:
+            try:
+                slot.file_client.delete_file({"name": name})
+                stale.append(name)
+            except Exception as e:
+                logger.error(f"删除上传文件 {name} 失败: {str(e)}")
+        if registry is not None:
+            registry.forget(slot.key_id, stale)
+        logger.info(f"第 {slot.index + 1} 个API密钥清理了 {len(stale)} 个上传文件")
+        deleted += len(stale)
+    return deleted
+
+
+TEXT_PAGE_INTRO = "以下是這一頁PDF的文字內容（代替整頁圖片），後面附上頁面中的插圖：\n"
+
+
+def page_parts(page, page_num, file_client=None, uploader=None, key_id=None):
+    """把一页转换成请求内容：文字页发送文字和插图，其余发送整页图片"""
+    def _image_part(page_image):
+        if uploader is not None:
+            return uploader.image_part(
+                page_image, page_num, file_client=file_client, key_id=key_id)
+        return upload_page_image(page_image, page_num, file_client)
+
+    if isinstance(page, PageText):
+        return [TEXT_PAGE_INTRO + page.text] + [
+            _image_part(figure) for figure in page.figures]
+    # 统一为已编码的页面图片，直接从内存发送，不再写临时文件
+    return [_image_part(encode_image(page))]
+
+
+def tag_result(response, fields):
+    """往结果json里追加字段；响应不是json对象时原样返回"""
+    if not response:
+        return response
+    try:
+        result = json.loads(response)
+    except ValueError:
+        return response
+    if not isinstance(result, dict):
+        return response
+    result.update(fields)
+    return json.dumps(result, ensure_ascii=False)
+
+
+def tag_route(response, page):
+    """在结果json里注明这一页是按文字还是按图片分析的"""
+    route = getattr(page, "route", None)
+    if route is None:
+        return response
+    return tag_result(response, {'处理方式': route})
+
+
 # 处理单页查询
 
 
 def convert_image_to_base64(image):
-    """将PIL Image转换为base64字符串"""
+    """将页面图片转换为base64字符串，已编码的 PageImage 直接复用字节"""
+    if isinstance(image, PageImage):
+        return base64.b64encode(image.data).decode()
     buffered = io.BytesIO()
     image.save(buffered, format="PNG")
     img_str = base64.b64encode(buffered.getvalue()).decode()
@@ -280,53 +950,1332 @@ json 維持一層就好 key: string value，確保都是 "key": "value"
 """
 
 
-
-def query_page(model, image, question, page_num):
+def prompt_fields(prompt_text):
+    """从提示词模板的「填入以下欄位: ...，」一句读出要输出的字段，读不到时返回 None"""
+    match = re.search(r"填入以下欄位[:：]\s*([^，,\n]+)", prompt_text)
+    if match is None:
+        return None
+    return match.group(1).split()
+
+
+def response_schema(fields, batch=False):
+    """每个字段都是字符串的一层对象；batch 时是带页码的对象数组"""
+    import google.generativeai as genai
+
+    properties = {
+        field: genai.protos.Schema(type=genai.protos.Type.STRING) for field in fields
+    }
+    required = list(fields)
+    if batch:
+        properties['页码'] = genai.protos.Schema(type=genai.protos.Type.INTEGER)
+        required.append('页码')
+    schema = genai.protos.Schema(
+        type=genai.protos.Type.OBJECT, properties=properties, required=required)
+    if batch:
+        return genai.protos.Schema(type=genai.protos.Type.ARRAY, items=schema)
+    return schema
+
+
+def generation_config_for(prompt_text):
+    """在 GENERATION_CONFIG 上加上该提示词模板对应的 response_schema"""
+    fields = prompt_fields(prompt_text)
+    if not fields:
+        return dict(GENERATION_CONFIG)
+    return dict(GENERATION_CONFIG, response_schema=response_schema(fields))
+
+
+def query_page(model, image, question, page_num, file_client=None,
+               uploader=None, key_id=None, raise_errors=False, on_partial=None,
+               metrics=None):
+    """分析单页，返回响应文本；传入 on_partial 时流式生成，每收到一段就回调已生成的全文"""
     try:
         logger.info(f"开始分析第 {page_num} 页")
 
-        # 将PIL Image保存为临时文件
-        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
-            image.save(tmp_file, format='PNG')
-            tmp_file_path = tmp_file.name
+        # 创建聊天会话；模型引用了缓存的提示词时不再重复发送
+        with metric_span(metrics, "upload", page_num):
+            parts = page_parts(image, page_num, file_client=file_client,
+                               uploader=uploader, key_id=key_id)
+        if not model.cached_content:
+            parts.append(prompt)
+        chat = model.start_chat(
+            history=[
+                {
+                    "role": "user",
+                    "parts": parts,
+                }
+            ]
+        )
 
-        try:
-            # 上传图片到Gemini
-            logger.info(f"上传图片到Gemini - 第 {page_num} 页")
-            uploaded_file = genai.upload_file(
-                tmp_file_path, mime_type="image/png")
-            logger.info(f"图片上传成功: {uploaded_file.uri}")
-
-            # 创建聊天会话
-            chat = model.start_chat(
-                history=[
-                    {
-                        "role": "user",
-                        "parts": [
-                            uploaded_file,
-                            prompt,
-                        ],
-                    }
-                ]
-            )
+        logger.info(f"发送请求到Gemini API - 第 {page_num} 页")
+        with metric_span(metrics, "generate", page_num):
+            if on_partial is None:
+                response = chat.send_message("请提供产品分析结果")
+                text = response.text
+            else:
+                response = chat.send_message("请提供产品分析结果", stream=True)
+                text = ""
+                for chunk in response:
+                    # 最后一段可能只有结束原因没有内容
+                    if chunk.parts:
+                        text += chunk.text
+                        on_partial(text)
+        if metrics is not None:
+            metrics.add_usage(response.usage_metadata)
+        logger.info(f"收到Gemini API响应 - 第 {page_num} 页")
+        logger.info(text)
+        return text  # 直接返回响应文本
 
-            logger.info(f"发送请求到Gemini API - 第 {page_num} 页")
-            response = chat.send_message("请提供产品分析结果")
-            logger.info(f"收到Gemini API响应 - 第 {page_num} 页")
-            logger.info(response.text)
-            return response.text  # 直接返回响应文本
+    except Exception as e:
+        logger.error(f"查询页面时出错 - 第 {page_num} 页: {str(e)}")
+        logger.error(traceback.format_exc())
+        if raise_errors:
+            raise
+        return None
 
-        finally:
-            # 清理临时文件
-            os.unlink(tmp_file_path)
 
+# 响应缓存默认配置，可在 secrets.toml 中通过 RESPONSE_CACHE_* 覆盖
+DEFAULT_CACHE_PATH = os.path.join(".cache", "responses.sqlite3")
+DEFAULT_CACHE_MAX_MB = 200
+DEFAULT_CACHE_MAX_AGE_DAYS = 30
+
+
+def make_cache_key(page_data, prompt_text, model_name, generation_config):
+    """以页面图片字节、提示词、模型名称和生成配置计算内容地址"""
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(page_data).digest())
+    digest.update(prompt_text.encode("utf-8"))
+    digest.update(model_name.encode("utf-8"))
+    digest.update(json.dumps(generation_config, sort_keys=True,
+                             ensure_ascii=False, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """以内容哈希为键的 Gemini 响应磁盘缓存（SQLite），按大小和时间淘汰"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_mb=DEFAULT_CACHE_MAX_MB,
+                 max_age_days=DEFAULT_CACHE_MAX_AGE_DAYS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.max_age = max_age_days * 24 * 3600
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " response TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " accessed REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._conn.commit()
+        self.evict()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.max_age)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute(
+                "UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, response):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, response, len(response.encode("utf-8")), now, now))
+            self._conn.commit()
+        self.evict()
+
+    def evict(self):
+        """删除过期条目，总大小超限时按最近访问时间淘汰"""
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM responses WHERE created < ?",
+                (time.time() - self.max_age,))
+            total = self._conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._conn.execute(
+                    "SELECT key, size FROM responses ORDER BY accessed").fetchall()
+                stale = []
+                for key, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self._conn.executemany(
+                    "DELETE FROM responses WHERE key = ?", stale)
+                logger.info(f"响应缓存超出大小限制，淘汰 {len(stale)} 条")
+            self._conn.commit()
+
+    def stats(self):
+        with self._lock:
+            entries, total = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses,
+                "entries": entries, "bytes": total}
+
+
+BATCH_PROMPT_TEMPLATE = """
+＝＝＝＝＝ 多頁批次輸出注意事項（這次覆蓋上面「開頭要是 {{ 結尾要是 }}」的要求）：
+這次一共有 {count} 張圖片，每張圖片前面都標註了頁碼：{page_nums}
+每一頁分別依照上面的欄位和格式產生一個 json 物件，並加上 "页码" 欄位（整數）。
+整體輸出一個 json 陣列，開頭是 [ 結尾是 ]，每一頁一個物件，順序和頁碼一致。
+"""
+
+
+def parse_batch_response(response_text, page_nums):
+    """把批量请求返回的 json 数组拆回每一页，返回 {页码: 单页json文本}
+
+    格式不对时返回空字典，调用方会退回逐页请求。
+    """
+    try:
+        data, _ = loads_lenient(response_text)
+    except ValueError as e:
+        logger.error(f"批量响应不是合法的json: {str(e)}")
+        return {}
+    # 有时模型会把数组包在一个对象里
+    if isinstance(data, dict) and len(data) == 1:
+        data = next(iter(data.values()))
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        logger.error("批量响应不是对象数组")
+        return {}
+
+    results = {}
+    for position, item in enumerate(data):
+        page_num = item.pop('页码', None)
+        try:
+            page_num = int(page_num)
+        except (TypeError, ValueError):
+            # 没有页码时，只有数量完全一致才按顺序对应
+            if len(data) != len(page_nums):
+                continue
+            page_num = page_nums[position]
+        if page_num in page_nums and page_num not in results:
+            results[page_num] = json.dumps(item, ensure_ascii=False)
+    return results
+
+
+def query_batch(model, images, question, page_nums, file_client=None,
+                uploader=None, key_id=None, raise_errors=False, metrics=None):
+    """把多页图片放进同一个请求，提示词只发送一次，返回 {页码: 单页json文本}"""
+    try:
+        logger.info(f"开始批量分析第 {page_nums} 页")
+        if uploader is None:
+            uploader = ImageUploader()
+
+        parts = []
+        for image, page_num in zip(images, page_nums):
+            parts.append(f"第 {page_num} 页:")
+            with metric_span(metrics, "upload", page_num):
+                parts.extend(page_parts(image, page_num, file_client=file_client,
+                                        uploader=uploader, key_id=key_id))
+        if not model.cached_content:
+            parts.append(prompt)
+        parts.append(BATCH_PROMPT_TEMPLATE.format(
+            count=len(page_nums), page_nums=", ".join(map(str, page_nums))))
+
+        # 单页的对象 schema 换成带页码的数组 schema
+        generation_config = None
+        fields = prompt_fields(prompt)
+        if fields:
+            generation_config = {"response_schema": response_schema(fields, batch=True)}
+
+        chat = model.start_chat(history=[{"role": "user", "parts": parts}])
+        logger.info(f"发送批量请求到Gemini API - 第 {page_nums} 页")
+        with metric_span(metrics, "generate", page_nums):
+            response = chat.send_message("请提供每一页的产品分析结果",
+                                         generation_config=generation_config)
+        if metrics is not None:
+            metrics.add_usage(response.usage_metadata)
+        logger.info(f"收到Gemini API批量响应 - 第 {page_nums} 页")
+        logger.info(response.text)
+        return parse_batch_response(response.text, page_nums)
     except Exception as e:
-        logger.error(f"查询页面时出错 - 第 {page_num} 页: {str(e)}")
+        logger.error(f"批量查询时出错 - 第 {page_nums} 页: {str(e)}")
         logger.error(traceback.format_exc())
+        if raise_errors:
+            raise
+        return {}
+
+
+# 提示词上下文缓存：显式缓存需要带版本号的模型名
+CONTEXT_CACHE_MODEL_NAME = "models/gemini-2.0-flash-001"
+CONTEXT_CACHE_TTL = 3600
+# 剩余时间少于这个值时延长缓存有效期
+CONTEXT_CACHE_REFRESH_MARGIN = 10 * 60
+# 创建或续期失败后，这段时间内该密钥改为普通请求，之后再试
+CONTEXT_CACHE_RETRY_AFTER = 5 * 60
+
+
+class PromptContextCache:
+    """把固定的提示词前缀作为 cached content 上传一次，之后每页请求只引用它
+
+    每个API密钥各自维护一份缓存；提示词文本变化时删除旧缓存重新创建，
+    快过期时延长 TTL。提示词没达到最小缓存token数、模型不支持缓存这类
+    请求本身有问题的失败，这个提示词以后都不再尝试；503、429 等临时失败
+    CONTEXT_CACHE_RETRY_AFTER 秒内退回普通请求，之后再试。
+    """
+
+    def __init__(self, ttl=CONTEXT_CACHE_TTL, model_name=CONTEXT_CACHE_MODEL_NAME):
+        self.ttl = ttl
+        self.model_name = model_name
+        # 只保护下面几个字典；创建、续期的网络请求在各密钥自己的锁里进行
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        # key_id -> {"digest", "name", "expires", "model"}
+        self._entries = {}
+        # (key_id, 提示词哈希) -> 创建或续期临时失败后，下次可以再尝试的时间
+        self._retry_at = {}
+        # 无法缓存的提示词哈希，换哪个密钥都一样
+        self._unsupported = set()
+
+    def _key_lock(self, slot):
+        with self._lock:
+            return self._key_locks.setdefault(slot.key_id, threading.Lock())
+
+    def _usable(self, entry, digest):
+        """还没过期、提示词也没变的缓存条目对应的模型，否则返回 None"""
+        if entry is not None and entry["digest"] == digest and entry["expires"] > time.time():
+            return entry["model"]
+        return None
+
+    def model_for(self, slot, prompt_text):
+        """返回引用缓存提示词的模型；不可用时返回 None"""
+        digest = hashlib.sha256(prompt_text.encode("utf-8")).hexdigest()
+        if digest in self._unsupported:
+            return None
+        key_lock = self._key_lock(slot)
+        if not key_lock.acquire(blocking=False):
+            # 同一密钥的缓存正在创建或续期：有还有效的旧缓存就用，没有就走普通请求，不排队等待
+            return self._usable(self._entries.get(slot.key_id), digest)
+        try:
+            entry = self._entries.get(slot.key_id)
+            if entry is not None and entry["digest"] != digest:
+                logger.info(f"提示词已变化，删除第 {slot.index + 1} 个API密钥的旧上下文缓存")
+                self._delete(slot, entry)
+                entry = None
+            if (entry is not None and
+                    entry["expires"] - time.time() >= CONTEXT_CACHE_REFRESH_MARGIN):
+                return entry["model"]
+            if time.time() < self._retry_at.get((slot.key_id, digest), 0):
+                return self._usable(entry, digest)
+            try:
+                if entry is None:
+                    entry = self._create(slot, prompt_text, digest)
+                else:
+                    self._refresh(slot, entry)
+                self._retry_at.pop((slot.key_id, digest), None)
+                return entry["model"]
+            except Exception as e:
+                from google.api_core import exceptions as api_exceptions
+
+                if isinstance(e, (api_exceptions.InvalidArgument,
+                                  api_exceptions.FailedPrecondition)):
+                    # 提示词太短或模型不支持缓存，重试也不会成功
+                    logger.warning(f"当前提示词无法使用上下文缓存，改为普通请求: {str(e)}")
+                    self._unsupported.add(digest)
+                    return None
+                # 临时失败只在一段时间内不再尝试，之后重新创建或续期
+                logger.error(f"提示词上下文缓存不可用，{CONTEXT_CACHE_RETRY_AFTER} 秒内改为普通请求: "
+                             f"{str(e)}")
+                self._retry_at[(slot.key_id, digest)] = time.time() + CONTEXT_CACHE_RETRY_AFTER
+                return self._usable(entry, digest)
+        finally:
+            key_lock.release()
+
+    def _create(self, slot, prompt_text, digest):
+        import google.generativeai as genai
+
+        cached_content = slot.cache_client.create_cached_content(
+            cached_content=genai.protos.CachedContent(
+                model=self.model_name,
+                display_name=f"prompt-{digest[:12]}",
+                contents=[genai.protos.Content(
+                    role="user", parts=[genai.protos.Part(text=prompt_text)])],
+                ttl=datetime.timedelta(seconds=self.ttl),
+            ))
+        model = genai.GenerativeModel.from_cached_content(
+            cached_content, generation_config=slot.generation_config)
+        model._client = slot.model._client
+        entry = {
+            "digest": digest,
+            "name": cached_content.name,
+            "expires": time.time() + self.ttl,
+            "model": model,
+        }
+        self._entries[slot.key_id] = entry
+        logger.info(f"已创建提示词上下文缓存: {cached_content.name}")
+        return entry
+
+    def _refresh(self, slot, entry):
+        import google.generativeai as genai
+
+        slot.cache_client.update_cached_content(
+            cached_content=genai.protos.CachedContent(
+                name=entry["name"], ttl=datetime.timedelta(seconds=self.ttl)),
+            update_mask={"paths": ["ttl"]})
+        entry["expires"] = time.time() + self.ttl
+        logger.info(f"已延长提示词上下文缓存: {entry['name']}")
+
+    def _delete(self, slot, entry):
+        try:
+            slot.cache_client.delete_cached_content(name=entry["name"])
+        except Exception as e:
+            logger.error(f"删除上下文缓存 {entry['name']} 失败: {str(e)}")
+        self._entries.pop(slot.key_id, None)
+
+    def clear(self, pool):
+        """删除所有密钥下的上下文缓存"""
+        for slot in pool.slots:
+            with self._key_lock(slot):
+                entry = self._entries.get(slot.key_id)
+                if entry is not None:
+                    self._delete(slot, entry)
+
+
+# 限流与重试默认配置，可在 secrets.toml 中通过 GEMINI_RPM_PER_KEY 等覆盖
+DEFAULT_RPM_PER_KEY = 60
+DEFAULT_TPM_PER_KEY = 1_000_000
+# 单页请求的估算token数（提示词 + 图片 + 输出），用于TPM限流
+DEFAULT_TOKENS_PER_PAGE = 4000
+DEFAULT_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 2.0
+RETRY_MAX_DELAY = 60.0
+
+
+def non_retryable_errors():
+    """这些错误重试也不会成功，直接标记失败
+
+    候选结果被安全过滤拦截时读取 response.text 会抛 ValueError，同样的输入重试还是会被拦截。
+    """
+    from google.api_core import exceptions as api_exceptions
+
+    return (
+        api_exceptions.InvalidArgument,
+        api_exceptions.PermissionDenied,
+        api_exceptions.Unauthenticated,
+        api_exceptions.NotFound,
+        ValueError,
+    )
+
+
+class TokenBucket:
+    """令牌桶：按每分钟速率补充，预约式扣减，返回需要等待的秒数"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # 超过桶容量的请求按整桶计算，避免永远等不到
+        self.tokens -= min(amount, self.capacity)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class KeyRateLimiter:
+    """单个API密钥的 RPM/TPM 限流器，遇到429时降速，成功后逐步恢复"""
+
+    def __init__(self, rpm, tpm):
+        self.max_rpm = rpm
+        self.max_tpm = tpm
+        self.factor = 1.0
+        self.blocked_until = 0.0
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens):
+        with self._lock:
+            wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+            return max(wait, self.blocked_until - time.monotonic())
+
+    def _apply_factor(self):
+        self.requests.rate = self.max_rpm * self.factor / 60.0
+        self.tokens.rate = self.max_tpm * self.factor / 60.0
+
+    def throttle(self, pause=0.0):
+        """收到限流错误：速率减半，并让这个密钥暂停 pause 秒"""
+        with self._lock:
+            self.factor = max(0.05, self.factor * 0.5)
+            self._apply_factor()
+            self.blocked_until = max(self.blocked_until, time.monotonic() + pause)
+
+    def recover(self):
+        with self._lock:
+            if self.factor < 1.0:
+                self.factor = min(1.0, self.factor + 0.05)
+                self._apply_factor()
+
+
+def retry_hint(error):
+    """从服务端错误中读取建议的重试等待秒数，没有时返回 None"""
+    for detail in getattr(error, "details", None) or []:
+        # gRPC 返回 RetryInfo 消息，REST 返回带 retryDelay 字段的字典
+        delay = getattr(detail, "retry_delay", None)
+        if delay is not None:
+            return delay.seconds + delay.nanos / 1e9
+        if isinstance(detail, dict) and "retryDelay" in detail:
+            try:
+                return float(str(detail["retryDelay"]).rstrip("s"))
+            except ValueError:
+                pass
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
         return None
 
 
+class RequestScheduler:
+    """按密钥限流，并决定失败请求是否以及何时重试"""
+
+    def __init__(self, rpm=DEFAULT_RPM_PER_KEY, tpm=DEFAULT_TPM_PER_KEY,
+                 tokens_per_page=DEFAULT_TOKENS_PER_PAGE,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.tokens_per_page = tokens_per_page
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, slot):
+        with self._lock:
+            if slot.key_id not in self._limiters:
+                self._limiters[slot.key_id] = KeyRateLimiter(self.rpm, self.tpm)
+            return self._limiters[slot.key_id]
+
+    def wait(self, slot, pages=1, cancelled=None):
+        """阻塞直到这个密钥的 RPM/TPM 额度允许再发一个请求；cancelled 被设置时提前返回"""
+        delay = self.limiter(slot).reserve(self.tokens_per_page * pages)
+        if delay > 0:
+            logger.info(f"第 {slot.index + 1} 个API密钥限流，等待 {delay:.1f} 秒")
+            if cancelled is None:
+                time.sleep(delay)
+            else:
+                cancelled.wait(delay)
+
+    def on_success(self, slot):
+        self.limiter(slot).recover()
+
+    def retry_delay(self, slot, error, attempt):
+        """返回下次重试前的等待秒数；不应再重试时返回 None"""
+        from google.api_core import exceptions as api_exceptions
+
+        if isinstance(error, non_retryable_errors()) or attempt >= self.max_attempts:
+            return None
+        # 带抖动的指数退避
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        hint = retry_hint(error)
+        if hint is not None:
+            delay = max(delay, hint)
+        if isinstance(error, (api_exceptions.ResourceExhausted,
+                              api_exceptions.TooManyRequests)):
+            self.limiter(slot).throttle(hint or 0.0)
+        return delay
+
+
+DEFAULT_JOURNAL_DIR = os.path.join(".cache", "jobs")
+
+
+def prompt_digest():
+    """当前提示词的短哈希，提示词变化后旧结果不再复用"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+
+
+def pdf_content_hash(pdf_data):
+    return hashlib.sha256(pdf_data).hexdigest()
+
+
+class JobJournal:
+    """按PDF内容哈希保存的任务日志，每完成一页就追加一行，中断后可以续跑
+
+    每行记录页码、响应文本和当时提示词的哈希；提示词变化后旧记录不再算完成。
+    失败的页面也会记录，但续跑时会重新分析。
+    """
+
+    def __init__(self, job_id, directory=DEFAULT_JOURNAL_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.job_id = job_id
+        self.path = os.path.join(directory, f"{job_id}.jsonl")
+        self._lock = threading.Lock()
+
+    def append(self, page_index, response):
+        record = {
+            "page": page_index,
+            "prompt": prompt_digest(),
+            "status": "done" if response else "failed",
+            "response": response,
+            "time": time.time(),
+        }
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def load(self):
+        """读取已完成的页面，返回 {页码(从0开始): 响应文本}"""
+        completed = {}
+        if not os.path.exists(self.path):
+            return completed
+        digest = prompt_digest()
+        with open(self.path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 进程在写入时崩溃，最后一行可能不完整
+                    continue
+                if record.get("prompt") != digest:
+                    continue
+                if record.get("status") == "done":
+                    completed[record["page"]] = record["response"]
+                else:
+                    completed.pop(record["page"], None)
+        return completed
+
+    def missing_pages(self, total_pages, completed=None):
+        if completed is None:
+            completed = self.load()
+        return [i for i in range(total_pages) if i not in completed]
+
+
+DEFAULT_DEDUP_PATH = os.path.join(".cache", "fingerprints.sqlite3")
+# 相似度达到这个值（1 - 汉明距离/位数）才复用之前的结果
+DEFAULT_DEDUP_THRESHOLD = 0.97
+# 图片指纹用 16x16 的差值哈希（256位），比常见的 8x8 更不容易把同模板的不同商品当成重复
+IMAGE_HASH_SIZE = 16
+
+
+def image_dhash(img, hash_size=IMAGE_HASH_SIZE):
+    """差值感知哈希：缩成灰度小图后比较相邻像素的明暗"""
+    # JPEG 可以在解码时直接缩小，省掉大部分解码时间
+    img.draft("L", (hash_size * 4, hash_size * 4))
+    img = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = img.tobytes()
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def text_simhash(text, bits=64):
+    """SimHash：基于字符三元组，文字只有少量改动时哈希也很接近"""
+    text = "".join(text.split())
+    weights = [0] * bits
+    for i in range(max(1, len(text) - 2)):
+        digest = hashlib.blake2b(text[i:i + 3].encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        for bit in range(bits):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(bits) if weights[bit] > 0)
+
+
+def page_fingerprint(page):
+    """返回 (类型, 位数, 哈希值, 内容签名)，内容签名必须完全一致才算重复"""
+    if isinstance(page, PageText):
+        # 同一模板的商品页只差商品名和价格，SimHash 几乎不变，文字也必须完全一致
+        text = "".join(page.text.split())
+        signature = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return "text", 64, text_simhash(page.text), signature
+    page_image = encode_image(page)
+    # 差值哈希看不出价格、商品名这类小字的变化，文字层也必须完全一致；
+    # 没有文字层（扫描件）时无从核对，只复用字节完全相同的图片
+    text = "".join(page_image.text.split())
+    signature = hashlib.sha256(text.encode("utf-8") if text else page_image.data).hexdigest()
+    return ("image", IMAGE_HASH_SIZE * IMAGE_HASH_SIZE, image_dhash(page_image.to_pil()),
+            signature)
+
+
+class DuplicateIndex:
+    """页面指纹索引：文件内和以前处理过的文件中的近似重复页面直接复用结果
+
+    reused 是这个索引累计复用的页数。
+    """
+
+    def __init__(self, path=DEFAULT_DEDUP_PATH, threshold=DEFAULT_DEDUP_THRESHOLD):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.threshold = threshold
+        self.reused = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS fingerprints ("
+            " kind TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            # 内容签名：文字层的哈希，扫描件为图片字节的哈希
+            " prices TEXT NOT NULL,"
+            " prompt TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " page INTEGER NOT NULL,"
+            " response TEXT NOT NULL)")
+        self._conn.commit()
+        # 只加载当前提示词下的指纹，比较在内存中进行
+        self._prompt = prompt_digest()
+        self._entries = [
+            (kind, int(value, 16), prices, source, page, response)
+            for kind, value, prices, source, page, response in self._conn.execute(
+                "SELECT kind, hash, prices, source, page, response FROM fingerprints"
+                " WHERE prompt = ?", (self._prompt,))
+        ]
+
+    def find(self, fingerprint, threshold=None):
+        """找到最相似且超过阈值的页面，返回 (响应, 来源文件, 页码, 相似度) 或 None
+
+        threshold 按调用传入，不修改共享索引的默认阈值。
+        """
+        kind, bits, value, prices = fingerprint
+        threshold = self.threshold if threshold is None else threshold
+        best = None
+        with self._lock:
+            for entry_kind, entry_value, entry_prices, source, page, response in self._entries:
+                if entry_kind != kind or entry_prices != prices:
+                    continue
+                similarity = 1 - (value ^ entry_value).bit_count() / bits
+                if similarity >= threshold and (best is None or similarity > best[3]):
+                    best = (response, source, page, similarity)
+            if best is not None:
+                self.reused += 1
+        return best
+
+    def add(self, fingerprint, response, source, page_num):
+        kind, _, value, prices = fingerprint
+        with self._lock:
+            self._entries.append((kind, value, prices, source, page_num, response))
+            self._conn.execute(
+                "INSERT INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, format(value, "x"), prices, self._prompt, source, page_num, response))
+            self._conn.commit()
+
+
+def parse_partial_json(text):
+    """解析生成到一半的JSON对象，只保留已经完整生成的字段；还没有对象开头时返回 None"""
+    start = text.find("{")
+    if start < 0:
+        return None
+    text = text[start:]
+    stack = []
+    in_string = False
+    escaped = False
+    # 最后一个逗号的位置和当时未闭合的括号：截断到这里再补齐括号就是合法JSON
+    cut, closers = 1, "}"
+    for i, ch in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+            if not stack:
+                # 对象已经完整
+                cut, closers = i + 1, ""
+                break
+        elif ch == ",":
+            cut, closers = i, "".join(reversed(stack))
+    try:
+        result = json.loads(text[:cut] + closers)
+    except ValueError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+# 本地修复：代码块标记、单引号的键、多余的逗号
+_CODE_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$")
+_SINGLE_QUOTED_KEY = re.compile(r"([{,]\s*)'([^'\n]*)'(\s*:)")
+_TRAILING_COMMA = re.compile(r",(\s*[}\]])")
+_CURLY_QUOTES = str.maketrans({"“": '"', "”": '"'})
+# 字段值里连续的换行只保留一个
+_NEWLINES = re.compile(r"\s*\n\s*")
+
+
+def loads_lenient(text):
+    """宽松地解析JSON，返回 (结果, 是否做过修改)；修不好时抛出 ValueError"""
+    try:
+        return json.loads(text), False
+    except ValueError:
+        pass
+    text = _CODE_FENCE.sub("", text.strip())
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=0)
+    text = text[start:]
+    text = _SINGLE_QUOTED_KEY.sub(r'\1"\2"\3', text)
+    text = _TRAILING_COMMA.sub(r"\1", text)
+    try:
+        # strict=False 允许字符串里出现未转义的换行
+        return json.loads(text, strict=False), True
+    except ValueError:
+        pass
+    # 最后才替换中文引号，因为它们经常出现在正文里
+    return json.loads(text.translate(_CURLY_QUOTES), strict=False), True
+
+
+def _flatten_value(value):
+    """把字段值整理成字符串：数组逐项换行连接（单元素数组直接解开），换行不重复"""
+    if isinstance(value, list):
+        return "\n".join(_flatten_value(item) for item in value)
+    if isinstance(value, dict):
+        return "\n".join(f"{key}: {_flatten_value(item)}" for key, item in value.items())
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        return str(value)
+    # 模型有时输出字面的 \n 两个字符
+    return _NEWLINES.sub("\n", value.replace("\\n", "\n").strip())
+
+
+def repair_json(text):
+    """把接近合法的单页响应修成一层的 {字段: 字符串}
+
+    返回 (结果字典, 是否修复过)，修不好时返回 (None, False)。
+    只有原文不是合法JSON、或者结果包在单元素数组里时才算修复过，
+    去掉字段值首尾空白、合并换行这类整理不算。
+    """
+    try:
+        data, repaired = loads_lenient(text)
+    except ValueError:
+        return None, False
+    if isinstance(data, list) and len(data) == 1:
+        data, repaired = data[0], True
+    if not isinstance(data, dict):
+        return None, False
+    result = {key: _flatten_value(value) for key, value in data.items()}
+    return result, repaired
+
+
+class ResponseRepairer:
+    """校验每页响应：接近合法的JSON在本地修复，修不好才重新请求一次，并统计比例"""
+
+    def __init__(self):
+        self.pages = 0
+        self.repaired = 0
+        self.requeried = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+    def repair(self, response, page_num, requery=None, metrics=None):
+        """返回整理后的单页JSON文本；本地修不好时调用 requery() 重新请求，仍然不行返回 None"""
+        if not response:
+            # 请求本身失败，由重试逻辑处理
+            return response
+        with metric_span(metrics, "parse", page_num):
+            result, repaired = repair_json(response)
+        if result is None and requery is not None:
+            logger.warning(f"第 {page_num} 页的响应无法在本地修复，重新请求")
+            with self._lock:
+                self.requeried += 1
+            response = requery()
+            with metric_span(metrics, "parse", page_num):
+                result, repaired = repair_json(response) if response else (None, False)
+        with self._lock:
+            self.pages += 1
+            if result is None:
+                self.failed += 1
+            elif repaired:
+                self.repaired += 1
+        if result is None:
+            logger.error(f"第 {page_num} 页的响应不是合法的json，标记为失败")
+            return None
+        if repaired:
+            logger.info(f"第 {page_num} 页的json已在本地修复")
+        return json.dumps(result, ensure_ascii=False)
+
+    def stats(self):
+        with self._lock:
+            pages = self.pages or 1
+            return {
+                "pages": self.pages,
+                "repaired": self.repaired,
+                "requeried": self.requeried,
+                "failed": self.failed,
+                "repair_rate": self.repaired / pages,
+                "requery_rate": self.requeried / pages,
+            }
+
+
+# 工作线程结束标记
+_WORKER_DONE = object()
+# 流式生成中途的结果：(_PAGE_PARTIAL, 页码, 已生成的文本)
+_PAGE_PARTIAL = object()
+
+
+def analyze_pages(pool, images, question, max_workers=None, on_page_done=None,
+                  queue_size=None, cache=None, uploader=None, batch_size=1,
+                  context_cache=None, scheduler=None, page_indices=None,
+                  journal=None, dedup=None, source="", on_page_partial=None,
+                  repairer=None, metrics=None, dedup_threshold=None):
+    """并发分析所有页面，按页码顺序返回响应文本列表（失败的页面为 None）
+
+    images 可以是图片列表，也可以是 iter_pdf_images 这样的惰性生成器。
+    渲染线程把页面放入有界队列，分析线程从队列中取出，
+    这样第 N+1 页的渲染和第 N 页的 Gemini 请求可以重叠进行。
+    传入 cache 时，命中缓存的页面不会调用 API。
+    batch_size 大于 1 时，每 batch_size 页合并成一个请求，
+    批量结果缺页或格式错误的页面再逐页请求。
+    传入 context_cache 时，提示词通过上下文缓存引用，不随每个请求重复发送。
+    传入 scheduler 时按密钥限流，失败的页面退避重试，超过次数后标记失败。
+    page_indices 是 images 对应的页码（从0开始），只分析部分页面时传入，
+    返回值与 page_indices 一一对应。传入 journal 时每页结果一到就写入任务日志。
+    传入 dedup 时，和已分析页面（包括 source 以外的文件）近似重复的页面直接复用结果，
+    相似度阈值用 dedup_threshold，不传时用 dedup 自己的默认值。
+    传入 on_page_partial 时单页请求改为流式生成，每收到一段就以
+    (页码, 已生成的文本) 回调，和 on_page_done 一样在调用线程中执行。
+    每页响应都经过 repairer 校验和本地修复，修不好的才重新请求一次。
+    传入 metrics 时记录上传、生成、解析各阶段耗时和token用量。
+    工作线程出错时该批页面记为失败（None），其余页面照常分析，全部结束后再抛出错误。
+    回调抛出异常时不再发出新的请求，已经发出的请求完成后仍写入任务日志。
+    """
+    max_workers = max_workers or pool.max_workers
+    repairer = repairer or ResponseRepairer()
+    page_queue = queue.Queue(maxsize=queue_size or max_workers)
+    result_queue = queue.Queue()
+    cancelled = threading.Event()
+    responses = {}
+
+    def _lookup(page_index, image):
+        """查缓存，返回 (缓存的响应, 缓存键, 图片)"""
+        if cache is None:
+            return None, None, image
+        image = encode_image(image)
+        cache_key = make_cache_key(
+            image.data, prompt, pool.model_name, pool.generation_config)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"第 {page_index + 1} 页命中响应缓存")
+        return cached, cache_key, image
+
+    def _model_for(slot):
+        if context_cache is not None:
+            model = context_cache.model_for(slot, prompt)
+            if model is not None:
+                return model
+        return slot.model
+
+    def _store(cache_key, response):
+        if cache_key is not None and response:
+            cache.put(cache_key, response)
+
+    def _partial_sender(page_index):
+        if on_page_partial is None:
+            return None
+        return lambda text: result_queue.put((_PAGE_PARTIAL, page_index, text))
+
+    def _request(page_index, image):
+        on_partial = _partial_sender(page_index)
+        attempt = 0
+        while True:
+            if cancelled.is_set():
+                return None
+            attempt += 1
+            delay = None
+            with pool.acquire() as slot:
+                # 等待密钥期间调用方可能已经退出
+                if cancelled.is_set():
+                    return None
+                logger.info(f"第 {page_index + 1} 页使用第 {slot.index + 1} 个API密钥")
+                if scheduler is None:
+                    response = query_page(
+                        _model_for(slot), image, question, page_index + 1,
+                        file_client=slot.file_client,
+                        uploader=uploader, key_id=slot.key_id, on_partial=on_partial,
+                        metrics=metrics)
+                    break
+                scheduler.wait(slot, cancelled=cancelled)
+                if cancelled.is_set():
+                    return None
+                try:
+                    response = query_page(
+                        _model_for(slot), image, question, page_index + 1,
+                        file_client=slot.file_client,
+                        uploader=uploader, key_id=slot.key_id, raise_errors=True,
+                        on_partial=on_partial, metrics=metrics)
+                    scheduler.on_success(slot)
+                    break
+                except Exception as e:
+                    delay = scheduler.retry_delay(slot, e, attempt)
+            if delay is None:
+                logger.error(f"第 {page_index + 1} 页尝试 {attempt} 次后仍失败，标记为失败")
+                response = None
+                break
+            # 退避等待时释放密钥，让其他页面先用
+            logger.info(f"第 {page_index + 1} 页第 {attempt} 次失败，{delay:.1f} 秒后重试")
+            cancelled.wait(delay)
+        return response
+
+    def _request_batch(pending):
+        """整批请求；失败时和单页请求一样按 scheduler 退避重试，放弃后返回空字典"""
+        page_nums = [page_index + 1 for page_index, _, _ in pending]
+        batch_images = [image for _, image, _ in pending]
+        attempt = 0
+        while True:
+            if cancelled.is_set():
+                return {}
+            attempt += 1
+            delay = None
+            with pool.acquire() as slot:
+                if cancelled.is_set():
+                    return {}
+                logger.info(f"第 {page_nums} 页使用第 {slot.index + 1} 个API密钥")
+                if scheduler is None:
+                    return query_batch(
+                        _model_for(slot), batch_images, question, page_nums,
+                        file_client=slot.file_client, uploader=uploader,
+                        key_id=slot.key_id, metrics=metrics)
+                scheduler.wait(slot, pages=len(pending), cancelled=cancelled)
+                if cancelled.is_set():
+                    return {}
+                try:
+                    batch_responses = query_batch(
+                        _model_for(slot), batch_images, question, page_nums,
+                        file_client=slot.file_client, uploader=uploader,
+                        key_id=slot.key_id, raise_errors=True, metrics=metrics)
+                    scheduler.on_success(slot)
+                    return batch_responses
+                except Exception as e:
+                    # 429 在这里让密钥降速，逐页请求不会马上再撞上限流
+                    delay = scheduler.retry_delay(slot, e, attempt)
+            if delay is None:
+                logger.error(f"第 {page_nums} 页批量请求尝试 {attempt} 次后仍失败，改为逐页请求")
+                return {}
+            logger.info(f"第 {page_nums} 页批量请求第 {attempt} 次失败，{delay:.1f} 秒后重试")
+            cancelled.wait(delay)
+
+    def _analyze(page_index, image, cache_key=None):
+        response = repairer.repair(
+            _request(page_index, image), page_index + 1,
+            requery=lambda: _request(page_index, image), metrics=metrics)
+        _store(cache_key, response)
+        return response
+
+    def _find_duplicate(page_index, image, cache_key):
+        """近似重复时返回标注了来源的响应；否则返回 (None, 指纹) 供分析后登记"""
+        if dedup is None:
+            return None, None
+        fingerprint = page_fingerprint(image)
+        match = dedup.find(fingerprint, dedup_threshold)
+        if match is None:
+            return None, fingerprint
+        response, match_source, match_page, similarity = match
+        logger.info(f"第 {page_index + 1} 页与 {match_source} 第 {match_page} 页相似度 "
+                    f"{similarity:.3f}，复用结果")
+        _store(cache_key, response)
+        return tag_result(response, {'复用自': f"{match_source} 第{match_page}页"}), None
+
+    def _post(page_index, response, posted):
+        """写任务日志并交给调用线程；日志在工作线程里写，调用方中途退出时已完成的页面也不会丢"""
+        if journal is not None:
+            journal.append(page_index, response)
+        result_queue.put((page_index, response))
+        posted.add(page_index)
+
+    def _analyze_batch(batch, posted):
+        """分析一批页面，已经放进结果队列的页码记在 posted 里"""
+        pending = []
+        fingerprints = {}
+        for page_index, image in batch:
+            cached, cache_key, image = _lookup(page_index, image)
+            if cached is None:
+                cached, fingerprints[page_index] = _find_duplicate(
+                    page_index, image, cache_key)
+            if cached is not None:
+                _post(page_index, tag_route(cached, image), posted)
+            else:
+                pending.append((page_index, image, cache_key))
+
+        batch_responses = {}
+        if len(pending) > 1:
+            batch_responses = _request_batch(pending)
+
+        for page_index, image, cache_key in pending:
+            response = batch_responses.get(page_index + 1)
+            if response is None:
+                if len(pending) > 1:
+                    logger.info(f"第 {page_index + 1} 页不在批量结果中，改为单页请求")
+                response = _analyze(page_index, image, cache_key)
+            else:
+                response = repairer.repair(response, page_index + 1, metrics=metrics)
+                _store(cache_key, response)
+            if response and fingerprints.get(page_index) is not None:
+                dedup.add(fingerprints[page_index], response, source, page_index + 1)
+            _post(page_index, tag_route(response, image), posted)
+
+    def _put_page(batch):
+        """放入页面队列；调用方已经退出时放弃，渲染线程不会永远阻塞在满队列上"""
+        while not cancelled.is_set():
+            try:
+                page_queue.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce():
+        try:
+            batch = []
+            if page_indices is None:
+                pages = enumerate(images)
+            else:
+                pages = zip(page_indices, images)
+            for page_index, image in pages:
+                batch.append((page_index, image))
+                if len(batch) >= batch_size:
+                    if not _put_page(batch):
+                        return
+                    batch = []
+            if batch:
+                _put_page(batch)
+        except Exception as e:
+            result_queue.put(e)
+        finally:
+            for _ in range(max_workers):
+                _put_page(None)
+
+    def _consume():
+        try:
+            while not cancelled.is_set():
+                try:
+                    batch = page_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if batch is None:
+                    break
+                posted = set()
+                try:
+                    _analyze_batch(batch, posted)
+                except Exception as e:
+                    # 缓存、去重索引等本地存储出错时，这一批标记为失败，线程继续处理后面的页面
+                    logger.error(f"分析第 {[page_index + 1 for page_index, _ in batch]} 页时出错: "
+                                 f"{str(e)}")
+                    logger.error(traceback.format_exc())
+                    for page_index, _ in batch:
+                        if page_index not in posted:
+                            result_queue.put((page_index, None))
+                    result_queue.put(e)
+                # 释放对图片的引用，避免已分析的页面滞留在内存中
+                del batch
+        finally:
+            result_queue.put(_WORKER_DONE)
+
+    logger.info(f"开始并发分析，并发数: {max_workers}，每个请求 {batch_size} 页")
+    threads = [threading.Thread(target=_produce, daemon=True)]
+    threads += [threading.Thread(target=_consume, daemon=True)
+                for _ in range(max_workers)]
+    for thread in threads:
+        thread.start()
+
+    # 回调在调用线程中执行，可以安全地更新 Streamlit 组件
+    error = None
+    running = max_workers
+    try:
+        while running:
+            item = result_queue.get()
+            if item is _WORKER_DONE:
+                running -= 1
+            elif isinstance(item, Exception):
+                error = item
+            elif item[0] is _PAGE_PARTIAL:
+                on_page_partial(item[1], item[2])
+            else:
+                page_index, response = item
+                responses[page_index] = response
+                if metrics is not None:
+                    metrics.page_done()
+                if on_page_done:
+                    on_page_done(page_index, response)
+    finally:
+        # 回调抛出异常（例如 Streamlit 重新运行脚本）时通知渲染线程和分析线程
+        # 不再发出新的请求，正在进行的请求结束后照常写入任务日志
+        cancelled.set()
+
+    for thread in threads:
+        thread.join()
+    if error is not None:
+        raise error
+    if page_indices is not None:
+        return [responses.get(page_index) for page_index in page_indices]
+    return [responses[page_index] for page_index in sorted(responses)]
+
+
+# 预定义所有可能的列
+EXPECTED_COLUMNS = [
+    '产品名称',
+    '产品卖点',
+    '市场价格',
+    '直播价格',
+    '产品信息',
+    '口味',
+    '赠品',
+    '产品卖点',
+    '其他优势',
+    '处理方式',
+    '复用自'
+]
+
+
+def parse_page_response(response, page_num):
+    """把单页响应解析为结果字典并加上页码，失败时返回 None"""
+    if not response:
+        return None
+    # 旧的缓存和任务日志里可能还有没修复过的响应
+    result, _ = repair_json(response)
+    if result is None:
+        logger.error(f"分析第 {page_num} 页时出错: 响应不是合法的json")
+        return None
+    result['页码'] = page_num
+    return result
+
+
+def results_to_dataframe(results, leading_columns=()):
+    """把结果列表整理成固定列顺序的表格，用于导出CSV"""
+    import pandas as pd
+
+    df = pd.DataFrame(results)
+    # 当前提示词模板的字段放在固定列后面、处理方式前面
+    template_columns = [field for field in prompt_fields(prompt) or []
+                        if field not in EXPECTED_COLUMNS]
+    split = EXPECTED_COLUMNS.index('处理方式')
+    columns = (list(leading_columns) + EXPECTED_COLUMNS[:split] + template_columns +
+               EXPECTED_COLUMNS[split:])
+
+    # 确保所有列都存在，缺失的填充空字符串
+    for col in columns:
+        if col not in df.columns:
+            df[col] = ''
+
+    # 按预定义顺序排列列
+    df = df[columns]
+
+    # 将所有 NaN 值替换为空字符串
+    return df.fillna('')
+
+
+# 分析过程中“下载已完成页面”的CSV按钮最多每隔这么多秒刷新一次
+PARTIAL_CSV_REFRESH_SECONDS = 2.0
+
+
+def show_page_result(result, page_store=None, show_page_images=False, pending=False):
+    """显示一页的分析结果；pending 表示还在生成中，此时不显示页面图片"""
+    title = f"第 {result['页码']} 页的分析"
+    if pending:
+        title += "（生成中…）"
+    with st.expander(title, expanded=True):
+        page_index = result['页码'] - 1
+        page_image = None
+        if (not pending and show_page_images and page_store is not None and
+                page_index in page_store):
+            page_image = page_store.image(page_index)
+        if page_image is not None:
+            image_col, result_col = st.columns([1, 2])
+            image_col.image(page_image)
+            result_col.json(result)
+        else:
+            st.json(result)
+
+
+def show_run_metrics(metrics):
+    """性能统计面板：各阶段 p50/p95、吞吐量和token用量，可导出"""
+    import pandas as pd
+
+    summary = metrics.summary()
+    with st.expander("性能统计", expanded=False):
+        pages_col, speed_col, tokens_col = st.columns(3)
+        pages_col.metric("分析页数", summary['pages'])
+        speed_col.metric("页/秒", f"{summary['pages_per_second']:.2f}")
+        tokens_col.metric("token/页", f"{summary['tokens_per_page']:.0f}")
+        st.dataframe(pd.DataFrame([
+            {"阶段": stage, "次数": stats['count'],
+             "p50 (ms)": round(stats['p50_ms'], 1), "p95 (ms)": round(stats['p95_ms'], 1),
+             "合计 (秒)": round(stats['total_seconds'], 2)}
+            for stage, stats in summary['stages'].items()
+        ]), hide_index=True)
+        json_col, prom_col = st.columns(2)
+        json_col.download_button(
+            "导出JSON", data=metrics.to_json(), file_name="run_metrics.json",
+            mime="application/json", key="metrics_json")
+        prom_col.download_button(
+            "导出Prometheus", data=metrics.to_prometheus(), file_name="run_metrics.prom",
+            mime="text/plain", key="metrics_prom")
+
+
+@st.cache_resource
+def get_response_cache():
+    """整个进程共用一个响应缓存，所有会话共享命中结果"""
+    return ResponseCache(
+        path=st.secrets.get("RESPONSE_CACHE_PATH", DEFAULT_CACHE_PATH),
+        max_mb=float(st.secrets.get("RESPONSE_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB)),
+        max_age_days=float(st.secrets.get(
+            "RESPONSE_CACHE_MAX_AGE_DAYS", DEFAULT_CACHE_MAX_AGE_DAYS)),
+    )
+
+
+@st.cache_resource
+def get_prompt_context_cache():
+    return PromptContextCache(
+        ttl=int(st.secrets.get("CONTEXT_CACHE_TTL", CONTEXT_CACHE_TTL)),
+        model_name=st.secrets.get("CONTEXT_CACHE_MODEL_NAME", CONTEXT_CACHE_MODEL_NAME),
+    )
+
+
+@st.cache_resource
+def get_request_scheduler():
+    """限流状态按密钥在整个进程内共享，多个会话不会各自打满配额"""
+    return RequestScheduler(
+        rpm=int(st.secrets.get("GEMINI_RPM_PER_KEY", DEFAULT_RPM_PER_KEY)),
+        tpm=int(st.secrets.get("GEMINI_TPM_PER_KEY", DEFAULT_TPM_PER_KEY)),
+        tokens_per_page=int(st.secrets.get(
+            "GEMINI_TOKENS_PER_PAGE", DEFAULT_TOKENS_PER_PAGE)),
+        max_attempts=int(st.secrets.get("GEMINI_MAX_ATTEMPTS", DEFAULT_MAX_ATTEMPTS)),
+    )
+
+
+@st.cache_resource
+def get_duplicate_index():
+    return DuplicateIndex(st.secrets.get("DEDUP_PATH", DEFAULT_DEDUP_PATH))
+
+
+@st.cache_resource
+def get_upload_registry():
+    return UploadRegistry(st.secrets.get(
+        "UPLOAD_REGISTRY_PATH", DEFAULT_UPLOAD_REGISTRY_PATH))
+
+
 def main():
+    # 设置页面配置；放在这里而不是模块顶层，命令行批处理导入本模块时不会触发
+    st.set_page_config(page_title="PDF AI阅读助手", layout="wide")
     try:
         st.title("PDF AI阅读助手")
         logger.info("应用程序启动")
@@ -334,105 +2283,259 @@ def main():
         # 初始化 session state
         if 'all_results' not in st.session_state:
             st.session_state.all_results = []
-        if 'processed_images' not in st.session_state:
-            st.session_state.processed_images = None
+        if 'page_store' not in st.session_state:
+            st.session_state.page_store = None  # 磁盘上的页面图片
+        if 'pdf_data' not in st.session_state:
+            st.session_state.pdf_data = None
+        if 'total_pages' not in st.session_state:
+            st.session_state.total_pages = 0
         if 'current_file_name' not in st.session_state:
             st.session_state.current_file_name = None
+        if 'current_file_id' not in st.session_state:
+            st.session_state.current_file_id = None  # 每次上传都不同，重新上传同一文件也会重新处理
         if 'processing_complete' not in st.session_state:
             st.session_state.processing_complete = False
         if 'current_page' not in st.session_state:
             st.session_state.current_page = 0  # 当前处理的页码
-
-        # 初始化模型
-        model = initialize_gemini()
-        if not model:
+        if 'job_id' not in st.session_state:
+            st.session_state.job_id = None  # 任务日志编号（PDF内容哈希）
+        if 'response_repairer' not in st.session_state:
+            st.session_state.response_repairer = ResponseRepairer()  # JSON修复统计
+        if 'run_metrics' not in st.session_state:
+            st.session_state.run_metrics = None  # 最近一次分析的性能统计
+
+        # 这里只检查密钥；模型和客户端等到真正要调用API时才构建（每个进程一次）
+        if not st.secrets.get("GOOGLE_API_KEYS"):
+            logger.error("API密钥未设置")
+            st.error("请在secrets.toml中设置GOOGLE_API_KEYS")
             return
 
+        max_workers = st.sidebar.number_input(
+            "并发请求数", min_value=1, max_value=64,
+            value=int(st.secrets.get("GEMINI_MAX_WORKERS", DEFAULT_MAX_WORKERS)))
+        stream_pages = st.sidebar.checkbox(
+            "边渲染边分析（流式）", value=True,
+            help="逐页渲染并立即送去分析，不再先把整个PDF转成图片")
+        extraction_mode = st.sidebar.selectbox(
+            "页面提取方式", list(EXTRACTION_MODES), format_func=EXTRACTION_MODES.get,
+            index=list(EXTRACTION_MODES).index(DEFAULT_EXTRACTION_MODE),
+            help="文字优先：有文字层且包含价格的页面只发送文字和插图，扫描页仍发送整页图片")
+        image_format = st.sidebar.selectbox(
+            "图片格式", list(IMAGE_FORMATS),
+            index=list(IMAGE_FORMATS).index(DEFAULT_IMAGE_FORMAT))
+        image_quality = st.sidebar.slider(
+            "图片质量", min_value=30, max_value=100, value=DEFAULT_IMAGE_QUALITY,
+            disabled=image_format == "png")
+        use_cache = st.sidebar.checkbox(
+            "使用响应缓存", value=True,
+            help="相同页面、提示词和模型配置的结果直接从本地缓存读取")
+        cache = get_response_cache() if use_cache else None
+        upload_mode = st.sidebar.selectbox(
+            "图片发送方式", list(UPLOAD_MODES), format_func=UPLOAD_MODES.get,
+            index=list(UPLOAD_MODES).index(DEFAULT_UPLOAD_MODE))
+        uploader = ImageUploader(upload_mode, registry=get_upload_registry())
+        use_dedup = st.sidebar.checkbox(
+            "复用近似重复页面的结果", value=False,
+            help="封面、版权页或跨期重复的商品页直接复用以前的分析结果")
+        dedup = None
+        dedup_threshold = None
+        if use_dedup:
+            # 索引由所有会话共用，阈值随每次分析传入
+            dedup = get_duplicate_index()
+            dedup_threshold = st.sidebar.slider(
+                "重复页相似度阈值", min_value=0.80, max_value=1.0,
+                value=DEFAULT_DEDUP_THRESHOLD, step=0.01)
+            st.sidebar.caption(f"已复用重复页面的结果 {dedup.reused} 页")
+        use_context_cache = st.sidebar.checkbox(
+            "缓存提示词上下文", value=True,
+            help="长提示词只上传一次，每页请求引用缓存，减少输入token")
+        context_cache = get_prompt_context_cache() if use_context_cache else None
+        batch_size = st.sidebar.number_input(
+            "每个请求的页数", min_value=1, max_value=10, value=1,
+            help="大于1时把多页合并成一个请求，返回格式不对的页面会自动逐页重试")
+        stream_results = st.sidebar.checkbox(
+            "实时显示生成中的结果", value=True,
+            help="流式接收Gemini的回复，每页的字段一生成完就显示，"
+                 "完成的页面立即出现在结果和CSV里")
+        show_page_images = st.sidebar.checkbox(
+            "在结果中显示页面图片", value=True,
+            help="关闭后页面图片分析完即删除")
+        if st.sidebar.button("清理过期上传文件"):
+            pool = initialize_gemini()
+            if pool is not None:
+                with st.spinner("正在清理上传文件..."):
+                    deleted = cleanup_stale_uploads(pool, get_upload_registry())
+                st.sidebar.success(f"已删除 {deleted} 个上传文件")
+
         # 文件上传
         uploaded_file = st.file_uploader("上传PDF文件", type=['pdf'])
 
         if uploaded_file:
-            # 检查是否需要重新处理PDF
-            if (st.session_state.current_file_name != uploaded_file.name or
-                    st.session_state.processed_images is None):
+            # 检查是否需要重新处理PDF；按上传编号判断，重新打开同一文件时
+            # 从任务日志续跑，上次失败的页面会重新分析
+            if (st.session_state.current_file_id != uploaded_file.file_id or
+                    st.session_state.pdf_data is None):
 
                 logger.info(f"处理新文件: {uploaded_file.name}")
-                # 转换PDF为图片
                 with st.spinner('正在处理文件...'):
-                    images = convert_pdf_to_images(uploaded_file)
-                    st.session_state.processed_images = images
+                    pdf_data = uploaded_file.read()
+                    st.session_state.pdf_data = pdf_data
+                    st.session_state.total_pages = count_pdf_pages(pdf_data)
+                    st.session_state.job_id = pdf_content_hash(pdf_data)
+                    # 页面图片只以压缩字节存放在临时目录，不在内存里保留解码图片
+                    if st.session_state.page_store is not None:
+                        st.session_state.page_store.close()
+                    page_store = PageStore()
+                    st.session_state.page_store = page_store
+                    # 流式模式下不预先转换，分析时再逐页渲染
+                    if not stream_pages:
+                        for page_index, page_image in enumerate(iter_pdf_images(
+                                pdf_data, image_format, image_quality,
+                                extraction_mode=extraction_mode)):
+                            page_store.put(page_index, page_image)
                     st.session_state.current_file_name = uploaded_file.name
+                    st.session_state.current_file_id = uploaded_file.file_id
                     st.session_state.processing_complete = False
                     st.session_state.all_results = []  # 清空之前的结果
                     st.session_state.current_page = 0  # 重置当前页码
 
             # 处理每一页
-            if st.session_state.processed_images is not None:
-                total_pages = len(st.session_state.processed_images)
-
-                # 处理未完成的页面
-                while st.session_state.current_page < total_pages:
-                    image = st.session_state.processed_images[st.session_state.current_page]
-                    with st.spinner(f'正在分析第 {st.session_state.current_page + 1}/{total_pages} 页...'):
-                        try:
-                            response = query_page(
-                                model, image, "分析产品信息", st.session_state.current_page + 1)
-                            if response:
-                                result = json.loads(response)
-                                result['页码'] = st.session_state.current_page + 1
-                                st.session_state.all_results.append(result)
-                                st.session_state.current_page += 1  # 处理下一页
-                        except Exception as e:
-                            logger.error(
-                                f"分析第 {st.session_state.current_page + 1} 页时出错: {str(e)}")
-                            st.error(
-                                f"第 {st.session_state.current_page + 1} 页分析失败，继续处理其他页面")
-                            st.session_state.current_page += 1  # 处理下一页
+            rendered_live = False
+            csv_slot = None
+            if st.session_state.pdf_data is not None:
+                total_pages = st.session_state.total_pages
+                status_slot = st.empty()
+
+                # 并发处理未完成的页面，结果按页码顺序写入
+                if st.session_state.current_page < total_pages:
+                    # 从任务日志恢复已完成的页面，只分析缺失或失败的页面
+                    journal = JobJournal(st.session_state.job_id)
+                    completed = journal.load()
+                    missing = journal.missing_pages(total_pages, completed)
+                    if completed:
+                        st.info(f"从上次中断处继续：已完成 {len(completed)} 页，"
+                                f"剩余 {len(missing)} 页")
+
+                    progress_bar = st.progress(
+                        len(completed) / total_pages,
+                        text=f'正在并发分析 {len(missing)} 页...')
+                    finished = []
+
+                    if st.session_state.page_store is None:
+                        st.session_state.page_store = PageStore()
+                    page_store = st.session_state.page_store
+
+                    # 每页预留一个位置，哪页先完成就先显示哪页，顺序仍按页码
+                    st.write("### 分析结果")
+                    csv_slot = st.empty()
+                    page_slots = [st.empty() for _ in range(total_pages)]
+                    rendered_live = True
+                    results_by_page = {}
+                    last_csv = 0.0
+
+                    def _show_result(page_index, response):
+                        result = parse_page_response(response, page_index + 1)
+                        if result is None:
+                            page_slots[page_index].error(
+                                f"第 {page_index + 1} 页分析失败，继续处理其他页面")
+                            return
+                        results_by_page[page_index] = result
+                        with page_slots[page_index].container():
+                            show_page_result(result, page_store, show_page_images)
+
+                    def _offer_partial_csv():
+                        # 已完成的页面随时可以下载；点击不重新运行脚本，分析继续进行
+                        nonlocal last_csv
+                        if time.monotonic() - last_csv < PARTIAL_CSV_REFRESH_SECONDS:
+                            return
+                        last_csv = time.monotonic()
+                        csv_slot.download_button(
+                            label=f"下载CSV文件（已完成 {len(results_by_page)} 页）",
+                            data=results_to_dataframe(
+                                st.session_state.all_results).to_csv(index=False),
+                            file_name=f"{st.session_state.current_file_name}_分析结果.csv",
+                            mime="text/csv",
+                            key=f"download_partial_{len(finished)}",
+                            on_click="ignore"
+                        )
+
+                    for page_index, response in sorted(completed.items()):
+                        _show_result(page_index, response)
+
+                    def _on_page_partial(page_index, text):
+                        partial = parse_partial_json(text)
+                        if partial:
+                            partial['页码'] = page_index + 1
+                            with page_slots[page_index].container():
+                                show_page_result(partial, pending=True)
+
+                    def _on_page_done(page_index, response):
+                        finished.append(page_index)
+                        # 不显示页面图片时，分析完就删掉
+                        if not show_page_images:
+                            page_store.release(page_index)
+                        _show_result(page_index, response)
+                        st.session_state.all_results = [
+                            results_by_page[i] for i in sorted(results_by_page)]
+                        _offer_partial_csv()
+                        done = len(completed) + len(finished)
+                        progress_bar.progress(
+                            done / total_pages,
+                            text=f'已完成 {done}/{total_pages} 页')
+
+                    if missing:
+                        pool = initialize_gemini()
+                        if pool is None:
+                            return
+                        metrics = RunMetrics()
+                        st.session_state.run_metrics = metrics
+                        if all(page_index in page_store for page_index in missing):
+                            pages = page_store.iter_pages(missing)
+                        else:
+                            pages = page_store.spool(iter_pdf_images(
+                                st.session_state.pdf_data, image_format, image_quality,
+                                page_indices=missing, extraction_mode=extraction_mode,
+                                metrics=metrics), missing, metrics=metrics)
+
+                        analyze_pages(
+                            pool, pages, "分析产品信息",
+                            max_workers=max_workers, on_page_done=_on_page_done,
+                            on_page_partial=_on_page_partial if stream_results else None,
+                            cache=cache, uploader=uploader, batch_size=batch_size,
+                            context_cache=context_cache,
+                            scheduler=get_request_scheduler(),
+                            page_indices=missing, journal=journal,
+                            dedup=dedup, dedup_threshold=dedup_threshold,
+                            source=st.session_state.current_file_name,
+                            repairer=st.session_state.response_repairer,
+                            metrics=metrics)
+                        metrics.finish()
+
+                    st.session_state.all_results = [
+                        results_by_page[i] for i in sorted(results_by_page)]
+                    st.session_state.current_page = total_pages
 
                 # 检查是否处理完成
                 if st.session_state.current_page >= total_pages:
                     st.session_state.processing_complete = True
-                    st.success(f'成功处理并分析完成，共{total_pages}页')
+                    status_slot.success(f'成功处理并分析完成，共{total_pages}页')
 
             # 显示结果（无论是新处理的还是之前处理过的）
             if st.session_state.processing_complete:
-                st.write("### 分析结果")
-
-                # 显示每页的结果
-                for result in st.session_state.all_results:
-                    with st.expander(f"第 {result['页码']} 页的分析", expanded=True):
-                        st.json(result)
+                # 本次运行中已经逐页显示过的，不再重复显示
+                if not rendered_live:
+                    st.write("### 分析结果")
+                    csv_slot = st.empty()
+                    for result in st.session_state.all_results:
+                        show_page_result(result, st.session_state.page_store,
+                                         show_page_images)
 
                 # 生成CSV下载按钮
                 if st.session_state.all_results:
-                    df = pd.DataFrame(st.session_state.all_results)
-
-                    # 预定义所有可能的列
-                    expected_columns = [
-                        '产品名称',
-                        '产品卖点',
-                        '市场价格',
-                        '直播价格',
-                        '产品信息',
-                        '口味',
-                        '赠品',
-                        '产品卖点',
-                        '其他优势'
-                    ]
-
-                    # 确保所有列都存在，缺失的填充空字符串
-                    for col in expected_columns:
-                        if col not in df.columns:
-                            df[col] = ''
-
-                    # 按预定义顺序排列列
-                    df = df[expected_columns]
-
-                    # 将所有 NaN 值替换为空字符串
-                    df = df.fillna('')
+                    df = results_to_dataframe(st.session_state.all_results)
 
                     csv = df.to_csv(index=False)
-                    st.download_button(
+                    csv_slot.download_button(
                         label="下载CSV文件",
                         data=csv,
                         file_name=f"{st.session_state.current_file_name}_分析结果.csv",
@@ -440,6 +2543,24 @@ def main():
                         key="download_button"
                     )
 
+                if st.session_state.run_metrics is not None:
+                    show_run_metrics(st.session_state.run_metrics)
+
+        # 显示缓存命中情况
+        if cache is not None:
+            stats = cache.stats()
+            st.sidebar.caption(
+                f"缓存命中 {stats['hits']} 次 / 未命中 {stats['misses']} 次，"
+                f"共 {stats['entries']} 条，{stats['bytes'] / 1024 / 1024:.1f} MB")
+        repair_stats = st.session_state.response_repairer.stats()
+        if repair_stats['pages']:
+            st.sidebar.caption(
+                f"JSON本地修复 {repair_stats['repaired']} 页"
+                f"（{repair_stats['repair_rate']:.1%}），"
+                f"重新请求 {repair_stats['requeried']} 页"
+                f"（{repair_stats['requery_rate']:.1%}），"
+                f"失败 {repair_stats['failed']} 页")
+
     except Exception as e:
         logger.error(f"主程序出错: {str(e)}")
         logger.error(traceback.format_exc())
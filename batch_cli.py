@@ -0,0 +1,262 @@
+"""命令行批处理：不启动 Streamlit，批量分析一个目录或通配符匹配的PDF
+
+用法:
+    python batch_cli.py "catalogs/*.pdf" -o output --concurrency 16
+
+API密钥从环境变量 GOOGLE_API_KEYS（逗号分隔，支持 .env）读取，
+没有时读取 .streamlit/secrets.toml 里的 GOOGLE_API_KEYS。
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tomllib
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+import app
+
+logger = logging.getLogger(__name__)
+
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+
+def load_api_keys():
+    """按 环境变量 → secrets.toml 的顺序读取API密钥列表"""
+    load_dotenv()
+    keys = [key.strip() for key in os.environ.get("GOOGLE_API_KEYS", "").split(",")
+            if key.strip()]
+    if not keys and os.path.exists(SECRETS_PATH):
+        with open(SECRETS_PATH, "rb") as f:
+            keys = list(tomllib.load(f).get("GOOGLE_API_KEYS", []))
+    return keys
+
+
+def find_pdfs(inputs):
+    """把目录和通配符展开成去重后的PDF路径列表"""
+    paths = []
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            # 不在通配符里写扩展名，大写的 .PDF 也能找到
+            pattern = os.path.join(pattern, "**", "*")
+        for path in sorted(glob.glob(pattern, recursive=True)):
+            if (path.lower().endswith(".pdf") and os.path.isfile(path) and
+                    path not in paths):
+                paths.append(path)
+    return paths
+
+
+def relative_names(paths):
+    """每个PDF相对于所有输入共同目录的路径，用作结果里的文件名和输出路径
+
+    目录输入会递归查找，不同子目录里可能有同名文件，只用文件名会互相覆盖。
+    """
+    dirs = [os.path.dirname(os.path.abspath(path)) for path in paths]
+    try:
+        root = os.path.commonpath(dirs)
+    except ValueError:
+        # Windows 上不同盘符没有共同目录，用盘符作为第一级目录
+        names = {}
+        for path in paths:
+            drive, tail = os.path.splitdrive(os.path.abspath(path))
+            names[path] = os.path.join(drive.rstrip(":"), tail.lstrip("\\/"))
+        return names
+    return {path: os.path.relpath(os.path.abspath(path), root) for path in paths}
+
+
+def write_results(results, base_path, leading_columns=()):
+    """写出同名的 .csv 和 .jsonl"""
+    app.results_to_dataframe(results, leading_columns).to_csv(
+        base_path + ".csv", index=False)
+    with open(base_path + ".jsonl", "w", encoding="utf-8") as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def process_file(path, name, pool, args, options):
+    """分析单个PDF，写出该文件的结果，返回 (结果列表, 总页数, 失败页数, 本次分析页数)
+
+    name 是 relative_names 给出的相对路径，输出按同样的目录结构写到 args.output 下。
+    """
+    logger.info(f"开始处理文件: {path}")
+    with open(path, "rb") as f:
+        pdf_data = f.read()
+
+    # 按内容哈希续跑：已完成的页面直接取任务日志里的结果
+    total_pages = app.count_pdf_pages(pdf_data)
+    journal = app.JobJournal(app.pdf_content_hash(pdf_data))
+    completed = journal.load() if args.resume else {}
+    missing = journal.missing_pages(total_pages, completed)
+    if completed:
+        logger.info(f"{path} 已完成 {len(completed)} 页，续跑剩余 {len(missing)} 页")
+
+    if missing:
+        responses = app.analyze_pages(
+            pool, app.iter_pdf_images(pdf_data, args.image_format, args.quality,
+                                      page_indices=missing,
+                                      extraction_mode=args.extract,
+                                      metrics=options["metrics"]),
+            "分析产品信息", max_workers=args.page_workers,
+            page_indices=missing, journal=journal,
+            source=name, **options)
+        completed.update(zip(missing, responses))
+
+    results = []
+    for page_index in range(total_pages):
+        result = app.parse_page_response(completed.get(page_index), page_index + 1)
+        if result is not None:
+            result['文件'] = name
+            results.append(result)
+
+    stem, _ = os.path.splitext(name)
+    base_path = os.path.join(args.output, f"{stem}_分析结果")
+    os.makedirs(os.path.dirname(base_path), exist_ok=True)
+    write_results(results, base_path, leading_columns=('文件', '页码'))
+    failed = total_pages - len(results)
+    logger.info(f"文件处理完成: {path}，共 {total_pages} 页，失败 {failed} 页")
+    return results, total_pages, failed, len(missing)
+
+
+def count_file_pages(path):
+    """处理出错的文件按全部页面失败计数；连页数都读不出来时返回 0"""
+    try:
+        with open(path, "rb") as f:
+            return app.count_pdf_pages(f.read())
+    except Exception:
+        return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PDF AI阅读助手 命令行批处理")
+    parser.add_argument("inputs", nargs="+", help="PDF目录或通配符，例如 catalogs/*.pdf")
+    parser.add_argument("-o", "--output", default="output", help="输出目录")
+    parser.add_argument("--concurrency", type=int, default=app.DEFAULT_MAX_WORKERS,
+                        help="所有文件合计的最大在途请求数")
+    parser.add_argument("--per-key-concurrency", type=int,
+                        default=app.DEFAULT_PER_KEY_CONCURRENCY)
+    parser.add_argument("--file-workers", type=int, default=2, help="同时处理的文件数")
+    parser.add_argument("--page-workers", type=int, default=None,
+                        help="每个文件的分析线程数，默认等于 --concurrency")
+    parser.add_argument("--batch-size", type=int, default=1, help="每个请求的页数")
+    parser.add_argument("--extract", choices=list(app.EXTRACTION_MODES),
+                        default=app.DEFAULT_EXTRACTION_MODE,
+                        help="hybrid: 文字层足够的页面只发送文字和插图")
+    parser.add_argument("--image-format", choices=list(app.IMAGE_FORMATS),
+                        default=app.DEFAULT_IMAGE_FORMAT)
+    parser.add_argument("--quality", type=int, default=app.DEFAULT_IMAGE_QUALITY)
+    parser.add_argument("--upload-mode", choices=list(app.UPLOAD_MODES),
+                        default=app.DEFAULT_UPLOAD_MODE)
+    parser.add_argument("--rpm", type=int, default=app.DEFAULT_RPM_PER_KEY,
+                        help="每个密钥每分钟请求数上限")
+    parser.add_argument("--tpm", type=int, default=app.DEFAULT_TPM_PER_KEY,
+                        help="每个密钥每分钟token数上限")
+    parser.add_argument("--no-cache", action="store_true", help="不使用响应缓存")
+    parser.add_argument("--no-context-cache", action="store_true",
+                        help="不使用提示词上下文缓存")
+    parser.add_argument("--dedup-threshold", type=float, default=None,
+                        help="复用近似重复页面的结果，例如 0.97；不指定则不复用")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="忽略任务日志，所有页面重新分析")
+    args = parser.parse_args(argv)
+    args.page_workers = args.page_workers or args.concurrency
+
+    api_keys = load_api_keys()
+    if not api_keys:
+        logger.error("API密钥未设置，请设置环境变量 GOOGLE_API_KEYS 或 secrets.toml")
+        return 1
+    paths = find_pdfs(args.inputs)
+    if not paths:
+        logger.error(f"没有找到PDF文件: {args.inputs}")
+        return 1
+    os.makedirs(args.output, exist_ok=True)
+    names = relative_names(paths)
+
+    pool = app.GeminiKeyPool(
+        api_keys, app.generation_config_for(app.prompt),
+        per_key_concurrency=args.per_key_concurrency,
+        max_workers=args.page_workers, max_in_flight=args.concurrency)
+    options = {
+        "batch_size": args.batch_size,
+        "cache": None if args.no_cache else app.ResponseCache(),
+        "uploader": app.ImageUploader(args.upload_mode, registry=app.UploadRegistry()),
+        "context_cache": None if args.no_context_cache else app.PromptContextCache(),
+        "scheduler": app.RequestScheduler(rpm=args.rpm, tpm=args.tpm),
+        "dedup": None,
+        "repairer": app.ResponseRepairer(),
+        "metrics": app.RunMetrics(),
+    }
+    if args.dedup_threshold is not None:
+        options["dedup"] = app.DuplicateIndex(threshold=args.dedup_threshold)
+
+    logger.info(f"共 {len(paths)} 个PDF文件，最大在途请求数 {pool.capacity}")
+    start = time.perf_counter()
+    all_results = []
+    total_pages = 0
+    total_failed = 0
+    analyzed_pages = 0
+    failed_files = []
+    lock = threading.Lock()
+
+    def _run(path):
+        nonlocal total_pages, total_failed, analyzed_pages
+        try:
+            results, pages, failed, analyzed = process_file(
+                path, names[path], pool, args, options)
+        except Exception as e:
+            logger.error(f"处理文件 {path} 时出错: {str(e)}")
+            logger.error(traceback.format_exc())
+            pages = count_file_pages(path)
+            with lock:
+                failed_files.append(path)
+                total_pages += pages
+                total_failed += pages
+            return
+        with lock:
+            all_results.extend(results)
+            total_pages += pages
+            total_failed += failed
+            analyzed_pages += analyzed
+
+    with ThreadPoolExecutor(max_workers=args.file_workers) as executor:
+        list(executor.map(_run, paths))
+
+    # 合并结果按输入文件顺序和页码排列
+    file_order = {names[path]: i for i, path in enumerate(paths)}
+    all_results.sort(key=lambda result: (file_order[result['文件']], result['页码']))
+    write_results(all_results, os.path.join(args.output, "全部分析结果"),
+                  leading_columns=('文件', '页码'))
+
+    elapsed = time.perf_counter() - start
+    metrics = options["metrics"]
+    metrics.finish()
+    with open(os.path.join(args.output, "运行统计.json"), "w", encoding="utf-8") as f:
+        f.write(metrics.to_json())
+    with open(os.path.join(args.output, "运行统计.prom"), "w", encoding="utf-8") as f:
+        f.write(metrics.to_prometheus())
+    # 从任务日志续跑的页面没有重新分析，不计入速度
+    print(f"完成 {len(paths)} 个文件，共 {total_pages} 页，失败 {total_failed} 页，"
+          f"本次分析 {analyzed_pages} 页，耗时 {elapsed:.1f} 秒，"
+          f"{analyzed_pages / elapsed:.2f} 页/秒")
+    if failed_files:
+        print(f"处理出错的文件 {len(failed_files)} 个: {', '.join(failed_files)}")
+    repair_stats = options["repairer"].stats()
+    print(f"JSON本地修复 {repair_stats['repaired']} 页（{repair_stats['repair_rate']:.1%}），"
+          f"重新请求 {repair_stats['requeried']} 页（{repair_stats['requery_rate']:.1%}），"
+          f"修复后仍失败 {repair_stats['failed']} 页")
+    if options["dedup"] is not None:
+        print(f"复用重复页面的结果 {options['dedup'].reused} 页")
+    summary = metrics.summary()
+    print(f"token/页 {summary['tokens_per_page']:.0f}")
+    for stage, stats in summary["stages"].items():
+        print(f"  {stage:<10} p50 {stats['p50_ms']:8.1f} ms   p95 {stats['p95_ms']:8.1f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,588 @@
+"""性能测试脚本
+
+用法:
+    python benchmark.py render [--pdf catalog.pdf] [--pages 20]
+    GOOGLE_API_KEYS=key1,key2 python benchmark.py batch --batch-sizes 1 3 5
+    python benchmark.py memory --page-counts 25 50 100 200
+    python benchmark.py offline --pages 100 --concurrency 1 4 8 16 --latency 1.5
+    python benchmark.py context-cache
+
+offline 子命令不调用真实API：用本地的假 Files API 和假 GenerativeModel 代替，
+可以配置延迟、错误率和429比例，测量整条 渲染 → 编码 → 请求 流水线的吞吐量。
+"""
+import argparse
+import io
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+
+import fitz  # PyMuPDF
+from google.api_core import exceptions as api_exceptions
+from PIL import Image
+
+import app
+
+
+def make_synthetic_pdf(page_count=20, width=595, height=842, photo_size=(400, 300)):
+    """生成带文字、色块和图片的合成商品目录PDF
+
+    width/height 是页面尺寸（点），photo_size 是嵌入商品图的像素尺寸。
+    """
+    pdf_document = fitz.open()
+    photo = Image.effect_noise(photo_size, 64).convert("RGB")
+    buffered = io.BytesIO()
+    photo.save(buffered, format="JPEG", quality=90)
+    photo_bytes = buffered.getvalue()
+
+    for page_num in range(page_count):
+        page = pdf_document.new_page(width=width, height=height)
+        page.draw_rect(fitz.Rect(36, 36, width - 36, 120),
+                       color=(0.8, 0.1, 0.1), fill=(0.95, 0.85, 0.85))
+        page.insert_text((48, 80), f"Product {page_num + 1}", fontsize=28)
+        page.insert_image(fitz.Rect(48, 140, width - 48, 460), stream=photo_bytes)
+        for line in range(12):
+            page.insert_text(
+                (48, 500 + line * 22),
+                f"Item {line + 1}: 500ml x 5   market 39.9   live 19.9",
+                fontsize=12)
+    data = pdf_document.tobytes()
+    pdf_document.close()
+    return data
+
+
+def legacy_render_page(page):
+    """原来的图片路径：150 DPI 渲染 → PNG → 解码 → LANCZOS 缩放 → PNG 临时文件"""
+    pix = page.get_pixmap(matrix=fitz.Matrix(150/72, 150/72))
+    img = Image.open(io.BytesIO(pix.tobytes("png")))
+    img = app.resize_image(img)
+    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp_file:
+        img.save(tmp_file, format='PNG')
+        tmp_file_path = tmp_file.name
+    size = os.path.getsize(tmp_file_path)
+    os.unlink(tmp_file_path)
+    return size
+
+
+def bench_render(pdf_data, quality):
+    """逐页比较旧路径与新路径的CPU时间和编码后大小"""
+    pdf_document = fitz.open(stream=pdf_data, filetype="pdf")
+    page_count = pdf_document.page_count
+    rows = []
+
+    def _measure(name, render):
+        cpu = 0.0
+        total_bytes = 0
+        for page_num in range(page_count):
+            start = time.process_time()
+            total_bytes += render(pdf_document[page_num])
+            cpu += time.process_time() - start
+        rows.append((name, cpu / page_count * 1000, total_bytes / page_count / 1024))
+
+    _measure("legacy png+tempfile", legacy_render_page)
+    for image_format in app.IMAGE_FORMATS:
+        _measure(
+            f"direct {image_format}",
+            lambda page, f=image_format: len(app.render_page(page, f, quality).data))
+    pdf_document.close()
+
+    print(f"共 {page_count} 页，质量 {quality}")
+    print(f"{'路径':<22}{'CPU ms/页':>12}{'KB/页':>10}")
+    for name, cpu_ms, kb in rows:
+        print(f"{name:<22}{cpu_ms:>12.1f}{kb:>10.1f}")
+
+
+def bench_batch(pdf_data, batch_sizes, max_workers):
+    """用真实API比较单页模式和批量模式的每分钟页数和每页token数"""
+    api_keys = [key.strip() for key in os.environ.get("GOOGLE_API_KEYS", "").split(",")
+                if key.strip()]
+    if not api_keys:
+        raise SystemExit("请通过环境变量 GOOGLE_API_KEYS 提供API密钥（逗号分隔）")
+    pool = app.GeminiKeyPool(
+        api_keys, app.generation_config_for(app.prompt), max_workers=max_workers)
+    page_count = app.count_pdf_pages(pdf_data)
+
+    rows = []
+    for batch_size in batch_sizes:
+        # token 从每个响应的 usage_metadata 累计
+        metrics = app.RunMetrics()
+        responses = app.analyze_pages(
+            pool, app.iter_pdf_images(pdf_data, metrics=metrics), "分析产品信息",
+            batch_size=batch_size, metrics=metrics)
+        metrics.finish()
+        summary = metrics.summary()
+        succeeded = sum(1 for response in responses if response)
+        rows.append((batch_size, succeeded, summary["pages_per_second"] * 60,
+                     summary["prompt_tokens"] / page_count,
+                     summary["output_tokens"] / page_count))
+
+    print(f"共 {page_count} 页，并发数 {max_workers}")
+    print(f"{'每请求页数':<10}{'成功页数':>10}{'页/分钟':>10}{'输入token/页':>14}{'输出token/页':>14}")
+    for batch_size, succeeded, pages_per_min, prompt_tokens, output_tokens in rows:
+        print(f"{batch_size:<10}{succeeded:>10}{pages_per_min:>10.1f}"
+              f"{prompt_tokens:>14.0f}{output_tokens:>14.0f}")
+
+
+def _peak_rss_worker(mode, page_count):
+    """在独立进程中跑一种页面保存方式，返回峰值RSS（MB）"""
+    pdf_data = make_synthetic_pdf(page_count)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if mode == "legacy":
+        # 原来的做法：每一页解码后的 PIL 图片都留在内存里
+        pdf_document = fitz.open(stream=pdf_data, filetype="pdf")
+        images = []
+        for page_num in range(pdf_document.page_count):
+            pix = pdf_document[page_num].get_pixmap(matrix=fitz.Matrix(150/72, 150/72))
+            img = app.resize_image(Image.open(io.BytesIO(pix.tobytes("png"))))
+            img.load()
+            images.append(img)
+        for img in images:
+            app.encode_image(img)
+        pdf_document.close()
+    else:
+        page_store = app.PageStore()
+        page_indices = list(range(page_count))
+        for page_image in page_store.spool(app.iter_pdf_images(pdf_data), page_indices):
+            pass
+        # 模拟分析：逐页从磁盘读出后释放，界面只显示少量解码图片
+        for page_index in page_indices:
+            page_store.get(page_index)
+            page_store.image(page_index)
+            page_store.release(page_index)
+        page_store.close()
+    # Linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, baseline / 1024
+
+
+def bench_memory(page_counts):
+    """比较内存中保存解码图片和磁盘页面存储的峰值RSS随页数的变化"""
+    context = multiprocessing.get_context("spawn")
+    print(f"{'页数':<8}{'方式':<10}{'峰值RSS MB':>12}{'增量 MB':>10}")
+    for page_count in page_counts:
+        for mode in ("legacy", "store"):
+            with context.Pool(1) as process_pool:
+                peak, baseline = process_pool.apply(_peak_rss_worker, (mode, page_count))
+            print(f"{page_count:<8}{mode:<10}{peak:>12.1f}{peak - baseline:>10.1f}")
+
+
+class FakeGeminiBackend:
+    """离线替身：代替 Files API 上传和 GenerativeModel 生成
+
+    每次请求按 latency ± jitter 秒睡眠，按 error_rate 抛出 503，
+    按 rate_limit_rate 抛出带 retryDelay 的 429，统计各类请求次数。
+    """
+
+    def __init__(self, latency=1.0, jitter=0.3, upload_latency=0.05, error_rate=0.0,
+                 rate_limit_rate=0.0, retry_after=1.0, output_tokens=600, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.upload_latency = upload_latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.output_tokens = output_tokens
+        self.requests = 0
+        self.uploads = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._fields = app.prompt_fields(app.prompt) or ["产品名称"]
+
+    def _roll(self):
+        """抽签决定这次请求成功、503 还是 429，并返回本次延迟"""
+        with self._lock:
+            self.requests += 1
+            roll = self._random.random()
+            delay = max(0.0, self._random.uniform(
+                self.latency - self.jitter, self.latency + self.jitter))
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                raise api_exceptions.ResourceExhausted(
+                    "429 Resource has been exhausted (fake)",
+                    details=[{"retryDelay": f"{self.retry_after}s"}])
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                error = api_exceptions.ServiceUnavailable("503 The service is unavailable (fake)")
+            else:
+                error = None
+        time.sleep(delay)
+        if error is not None:
+            raise error
+
+    def upload(self, data, mime_type=None, display_name=None):
+        """代替 genai.upload_file / FileServiceClient.create_file"""
+        with self._lock:
+            self.uploads += 1
+            name = f"files/fake-{self.uploads}"
+        time.sleep(self.upload_latency)
+        return SimpleNamespace(name=name, uri=f"https://fake.invalid/{name}",
+                               mime_type=mime_type, display_name=display_name,
+                               expiration_time=None)
+
+    def generate(self, history, stream=False):
+        self._roll()
+        parts = [part for message in history for part in message["parts"]]
+        # 批量请求里每页前面有「第 N 页:」标记
+        page_nums = [int(part.split()[1]) for part in parts
+                     if isinstance(part, str) and part.startswith("第 ") and part.endswith("页:")]
+        images = sum(1 for part in parts if not isinstance(part, str))
+        item = {field: "合成数据 " * 8 for field in self._fields}
+        if page_nums:
+            text = json.dumps([dict(item, 页码=page_num) for page_num in page_nums],
+                              ensure_ascii=False)
+        else:
+            text = json.dumps(item, ensure_ascii=False)
+        usage = SimpleNamespace(
+            prompt_token_count=1500 + 258 * images,
+            candidates_token_count=self.output_tokens * max(1, len(page_nums)))
+        if not stream:
+            return SimpleNamespace(text=text, parts=[text], usage_metadata=usage)
+        chunks = [text[i:i + 40] for i in range(0, len(text), 40)]
+        return FakeStreamResponse(
+            [SimpleNamespace(text=chunk, parts=[chunk]) for chunk in chunks], usage)
+
+    def file_client(self):
+        backend = self
+        return SimpleNamespace(
+            create_file=lambda data, mime_type=None, display_name=None: backend.upload(
+                data, mime_type, display_name))
+
+    def model(self):
+        return FakeGenerativeModel(self)
+
+
+class FakeStreamResponse:
+    def __init__(self, chunks, usage_metadata):
+        self._chunks = chunks
+        self.usage_metadata = usage_metadata
+
+    def __iter__(self):
+        return iter(self._chunks)
+
+
+class FakeGenerativeModel:
+    """只实现 app 用到的 GenerativeModel 接口：cached_content 和 start_chat"""
+    cached_content = None
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def start_chat(self, history=None):
+        backend = self.backend
+
+        def send_message(content, stream=False, generation_config=None):
+            return backend.generate(history or [], stream=stream)
+        return SimpleNamespace(send_message=send_message)
+
+
+class FakeCacheClient:
+    """代替 CacheServiceClient：在内存里创建、续期、删除 cached content
+
+    latency 模拟每次调用的网络耗时，fail_next 指定接下来多少次创建或续期抛出
+    error（默认 503）。
+    """
+
+    def __init__(self, latency=0.0, fail_next=0, error=None):
+        self.latency = latency
+        self.fail_next = fail_next
+        self.error = error or api_exceptions.ServiceUnavailable("503 The service is unavailable (fake)")
+        self.created = 0
+        self.refreshed = 0
+        self.deleted = 0
+        self.live = {}
+        self._lock = threading.Lock()
+
+    def _call(self):
+        time.sleep(self.latency)
+        with self._lock:
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                raise self.error
+
+    def create_cached_content(self, cached_content):
+        import google.generativeai as genai
+
+        self._call()
+        with self._lock:
+            self.created += 1
+            name = f"cachedContents/fake-{self.created}"
+            self.live[name] = cached_content.display_name
+        return genai.protos.CachedContent(name=name, model=cached_content.model)
+
+    def update_cached_content(self, cached_content, update_mask=None):
+        self._call()
+        with self._lock:
+            self.refreshed += 1
+        return cached_content
+
+    def delete_cached_content(self, name):
+        with self._lock:
+            self.deleted += 1
+            self.live.pop(name, None)
+
+
+def bench_context_cache():
+    """用假的缓存客户端检查 PromptContextCache 的创建、复用、续期、失败重试和并发行为"""
+    app.logger.setLevel(logging.CRITICAL)
+    pool = app.GeminiKeyPool(["offline-key-a", "offline-key-b"],
+                             app.generation_config_for(app.prompt))
+    slot_a, slot_b = pool.slots
+    for slot in pool.slots:
+        slot.cache_client = FakeCacheClient()
+    failures = []
+
+    def _check(condition, message):
+        print(f"{'通过' if condition else '失败'}  {message}")
+        if not condition:
+            failures.append(message)
+
+    cache = app.PromptContextCache()
+    first = cache.model_for(slot_a, app.prompt)
+    again = cache.model_for(slot_a, app.prompt)
+    _check(first is not None and again is first and slot_a.cache_client.created == 1,
+           "同一密钥只创建一次缓存，之后复用")
+    cache.model_for(slot_b, app.prompt)
+    _check(slot_b.cache_client.created == 1, "每个密钥各自创建一份缓存")
+
+    cache.model_for(slot_a, app.prompt + "\n修改")
+    _check(slot_a.cache_client.deleted == 1 and slot_a.cache_client.created == 2 and
+           len(slot_a.cache_client.live) == 1, "提示词变化时删除旧缓存并重新创建")
+
+    cache._entries[slot_b.key_id]["expires"] = time.time() + 60
+    model = cache.model_for(slot_b, app.prompt)
+    _check(model is not None and slot_b.cache_client.refreshed == 1, "快过期时续期")
+
+    # 临时失败：一段时间内走普通请求，不会永久禁用
+    slot_a.cache_client = FakeCacheClient(fail_next=1)
+    cache = app.PromptContextCache()
+    _check(cache.model_for(slot_a, app.prompt) is None, "创建失败时退回普通请求")
+    cache.model_for(slot_a, app.prompt)
+    _check(slot_a.cache_client.created == 0, "重试等待期内不再请求创建")
+    cache._retry_at[(slot_a.key_id, app.hashlib.sha256(
+        app.prompt.encode("utf-8")).hexdigest())] = 0
+    _check(cache.model_for(slot_a, app.prompt) is not None and
+           slot_a.cache_client.created == 1, "等待期过后重新创建成功")
+
+    # 提示词太短这类永久失败：所有密钥都不再尝试创建
+    slot_a.cache_client = FakeCacheClient(fail_next=1, error=api_exceptions.InvalidArgument(
+        "400 Cached content is too small (fake)"))
+    slot_b.cache_client = FakeCacheClient()
+    cache = app.PromptContextCache()
+    cache.model_for(slot_a, app.prompt)
+    cache.model_for(slot_b, app.prompt)
+    _check(cache.model_for(slot_a, app.prompt) is None and
+           slot_a.cache_client.created == 0 and slot_b.cache_client.created == 0,
+           "提示词无法缓存时不再尝试创建")
+
+    # 网络请求不在全局锁里：一个密钥创建很慢时，其他密钥和同密钥的其他线程都不用等
+    slot_a.cache_client = FakeCacheClient(latency=1.0)
+    slot_b.cache_client = FakeCacheClient()
+    cache = app.PromptContextCache()
+    creator = threading.Thread(target=cache.model_for, args=(slot_a, app.prompt))
+    creator.start()
+    time.sleep(0.1)
+    start = time.perf_counter()
+    other_key = cache.model_for(slot_b, app.prompt)
+    same_key = cache.model_for(slot_a, app.prompt)
+    elapsed = time.perf_counter() - start
+    creator.join()
+    _check(other_key is not None and same_key is None and elapsed < 0.5,
+           f"慢创建期间其他请求不阻塞（{elapsed * 1000:.0f} ms）")
+
+    cache.clear(pool)
+    _check(not slot_a.cache_client.live and not slot_b.cache_client.live, "clear 删除所有缓存")
+    if failures:
+        raise SystemExit(f"{len(failures)} 项检查失败")
+    print("全部通过")
+
+
+def _offline_worker(config):
+    """在独立进程中用假后端跑完整流水线，返回统计结果"""
+    # 注入的 503/429 会让 app 打出大量带堆栈的错误日志，结果表里已经有统计
+    app.logger.setLevel(logging.CRITICAL)
+    pdf_data = make_synthetic_pdf(config["pages"], config["width"], config["height"],
+                                  tuple(config["photo_size"]))
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    backend = FakeGeminiBackend(**config["backend"])
+    concurrency = config["concurrency"]
+    keys = config["keys"]
+    pool = app.GeminiKeyPool(
+        [f"offline-key-{i}" for i in range(keys)], app.generation_config_for(app.prompt),
+        per_key_concurrency=math.ceil(concurrency / keys), max_workers=concurrency,
+        max_in_flight=concurrency)
+    for slot in pool.slots:
+        slot.model = backend.model()
+        slot.file_client = backend.file_client()
+
+    metrics = app.RunMetrics()
+    page_store = app.PageStore()
+    page_indices = list(range(config["pages"]))
+    pages = page_store.spool(app.iter_pdf_images(
+        pdf_data, config["image_format"], config["quality"], page_indices=page_indices,
+        extraction_mode=config["extract"], metrics=metrics), page_indices, metrics=metrics)
+    responses = app.analyze_pages(
+        pool, pages, "分析产品信息", max_workers=concurrency,
+        on_page_done=lambda page_index, response: page_store.release(page_index),
+        on_page_partial=(lambda page_index, text: None) if config["stream"] else None,
+        uploader=app.ImageUploader(config["upload_mode"]), batch_size=config["batch_size"],
+        scheduler=app.RequestScheduler(rpm=config["rpm"], tpm=config["tpm"]),
+        page_indices=page_indices, metrics=metrics)
+    metrics.finish()
+    page_store.close()
+
+    # Linux 上 ru_maxrss 的单位是 KB
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {
+        "concurrency": concurrency,
+        "failed": sum(1 for response in responses if not response),
+        "requests": backend.requests,
+        "uploads": backend.uploads,
+        "errors": backend.errors,
+        "rate_limited": backend.rate_limited,
+        "peak_rss_mb": peak / 1024,
+        "rss_growth_mb": (peak - baseline) / 1024,
+        "summary": metrics.summary(),
+    }
+
+
+def bench_offline(args):
+    """不同并发数下，用假后端测量吞吐量、各阶段耗时和峰值内存"""
+    config = {
+        "pages": args.pages,
+        "width": args.width,
+        "height": args.height,
+        "photo_size": args.photo_size,
+        "keys": args.keys,
+        "image_format": args.image_format,
+        "quality": args.quality,
+        "extract": args.extract,
+        "upload_mode": args.upload_mode,
+        "batch_size": args.batch_size,
+        "stream": args.stream,
+        "rpm": args.rpm,
+        "tpm": args.tpm,
+        "backend": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "upload_latency": args.upload_latency,
+            "error_rate": args.error_rate,
+            "rate_limit_rate": args.rate_limit_rate,
+            "retry_after": args.retry_after,
+            "seed": args.seed,
+        },
+    }
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for concurrency in args.concurrency:
+        with context.Pool(1) as process_pool:
+            runs.append(process_pool.apply(
+                _offline_worker, (dict(config, concurrency=concurrency),)))
+
+    print(f"共 {args.pages} 页，页面 {args.width}x{args.height} 点，"
+          f"延迟 {args.latency}±{args.jitter} 秒，错误率 {args.error_rate:.0%}，"
+          f"429比例 {args.rate_limit_rate:.0%}")
+    print(f"{'并发数':<8}{'页/秒':>8}{'失败':>6}{'请求':>6}{'429':>6}{'503':>6}"
+          f"{'峰值RSS MB':>12}{'增量 MB':>10}")
+    for run in runs:
+        summary = run["summary"]
+        print(f"{run['concurrency']:<8}{summary['pages_per_second']:>8.2f}{run['failed']:>6}"
+              f"{run['requests']:>6}{run['rate_limited']:>6}{run['errors']:>6}"
+              f"{run['peak_rss_mb']:>12.1f}{run['rss_growth_mb']:>10.1f}")
+    print()
+    print(f"{'并发数':<8}{'阶段':<10}{'次数':>6}{'p50 ms':>10}{'p95 ms':>10}")
+    for run in runs:
+        for stage, stats in run["summary"]["stages"].items():
+            print(f"{run['concurrency']:<8}{stage:<10}{stats['count']:>6}"
+                  f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"config": config, "runs": runs}, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PDF AI阅读助手 性能测试")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = subparsers.add_parser("render", help="比较每页渲染和编码的CPU时间")
+    render_parser.add_argument("--pdf", help="要测试的PDF文件，不指定则生成合成PDF")
+    render_parser.add_argument("--pages", type=int, default=20)
+    render_parser.add_argument("--quality", type=int, default=app.DEFAULT_IMAGE_QUALITY)
+
+    batch_parser = subparsers.add_parser("batch", help="比较单页请求和多页批量请求（调用真实API）")
+    batch_parser.add_argument("--pdf", help="要测试的PDF文件，不指定则生成合成PDF")
+    batch_parser.add_argument("--pages", type=int, default=20)
+    batch_parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 3, 5])
+    batch_parser.add_argument("--workers", type=int, default=app.DEFAULT_MAX_WORKERS)
+
+    memory_parser = subparsers.add_parser("memory", help="比较不同页数下的峰值内存")
+    memory_parser.add_argument("--page-counts", type=int, nargs="+",
+                               default=[25, 50, 100, 200])
+
+    offline_parser = subparsers.add_parser(
+        "offline", help="用假的Gemini后端测量整条流水线（不消耗配额）")
+    offline_parser.add_argument("--pages", type=int, default=50)
+    offline_parser.add_argument("--width", type=int, default=595, help="页面宽度（点）")
+    offline_parser.add_argument("--height", type=int, default=842, help="页面高度（点）")
+    offline_parser.add_argument("--photo-size", type=int, nargs=2, default=[400, 300],
+                                metavar=("W", "H"), help="商品图像素尺寸")
+    offline_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8, 16])
+    offline_parser.add_argument("--keys", type=int, default=4, help="模拟的API密钥数")
+    offline_parser.add_argument("--latency", type=float, default=1.0, help="每个请求的平均秒数")
+    offline_parser.add_argument("--jitter", type=float, default=0.3)
+    offline_parser.add_argument("--upload-latency", type=float, default=0.05)
+    offline_parser.add_argument("--error-rate", type=float, default=0.0, help="503 比例")
+    offline_parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="429 比例")
+    offline_parser.add_argument("--retry-after", type=float, default=1.0,
+                                help="429 里建议的重试秒数")
+    offline_parser.add_argument("--seed", type=int, default=None)
+    offline_parser.add_argument("--rpm", type=int, default=100000,
+                                help="每个密钥的RPM上限，默认不限流")
+    offline_parser.add_argument("--tpm", type=int, default=10 ** 9)
+    offline_parser.add_argument("--batch-size", type=int, default=1)
+    offline_parser.add_argument("--stream", action="store_true", help="流式生成")
+    offline_parser.add_argument("--extract", choices=list(app.EXTRACTION_MODES),
+                                default=app.DEFAULT_EXTRACTION_MODE)
+    offline_parser.add_argument("--image-format", choices=list(app.IMAGE_FORMATS),
+                                default=app.DEFAULT_IMAGE_FORMAT)
+    offline_parser.add_argument("--quality", type=int, default=app.DEFAULT_IMAGE_QUALITY)
+    offline_parser.add_argument("--upload-mode", choices=list(app.UPLOAD_MODES),
+                                default=app.DEFAULT_UPLOAD_MODE)
+    offline_parser.add_argument("--json", help="把全部结果另存为JSON")
+
+    subparsers.add_parser("context-cache",
+                          help="用假的缓存客户端检查提示词上下文缓存的生命周期")
+
+    args = parser.parse_args()
+    if args.command == "context-cache":
+        bench_context_cache()
+        return
+    if args.command == "memory":
+        bench_memory(args.page_counts)
+        return
+    if args.command == "offline":
+        bench_offline(args)
+        return
+
+    if args.pdf:
+        with open(args.pdf, "rb") as f:
+            pdf_data = f.read()
+    else:
+        pdf_data = make_synthetic_pdf(args.pages)
+
+    if args.command == "render":
+        bench_render(pdf_data, args.quality)
+    elif args.command == "batch":
+        bench_batch(pdf_data, args.batch_sizes, args.workers)
+
+
+if __name__ == "__main__":
+    main()